@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Event loop based legend generation using gevent.
+
+Every layer job runs in a greenlet instead of a thread, so a single process
+can keep hundreds of WFS/WMS requests in flight. Concurrency is bounded by
+the greenlet pool size and per host by L{AsyncGeoServer.max_requests}.
+
+NB! This module monkey patches the standard library (sockets etc.) and
+should be imported (or run) before anything else.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse, logging, os, urlparse
+
+from gevent.lock import BoundedSemaphore
+from gevent.pool import Group, Pool
+
+from legender import GeoServer, Legend, build_jobs, get_layer, \
+    get_manifests, job_key, load_conf, reporting, run_job, set_layer, \
+    write_run_sprites
+
+
+class AsyncGeoServer(GeoServer):
+    """GeoServer with at most C{max_requests} concurrent requests per host."""
+    max_requests = 8
+    _semaphores = {}
+
+    def _semaphore(self, url):
+        # no need for a lock, greenlets don't switch in here
+        host = urlparse.urlparse(url).netloc
+        if host not in self._semaphores:
+            self._semaphores[host] = BoundedSemaphore(self.max_requests)
+        return self._semaphores[host]
+
+    def _get(self, url, session=None, request=None, **kwargs):
+        # every WFS, WMS, REST and background request goes through here
+        with self._semaphore(url):
+            return super(AsyncGeoServer, self)._get(
+                url, session, request, **kwargs)
+
+
+class AsyncLegend(Legend):
+    """Legend querying for all geometry types of a style concurrently."""
+    def _create_thumbnails(self, stylename, additional_filter):
+        # whole_feature as before the style for every geometry type, as in
+        # a serial run, where only the last one (Polygon) can latch it
+        self._whole_feature = self.whole_feature
+        return super(AsyncLegend, self)._create_thumbnails(
+            stylename, additional_filter)
+
+    def _get_extent(self, stylename, geometrytype, additional_filter):
+        # a shallow copy, so greenlets don't see each other latching
+        # whole_feature
+        legend = object.__new__(self.__class__)
+        legend.__dict__.update(self.__dict__)
+        legend.whole_feature = self._whole_feature
+        extent = super(AsyncLegend, legend)._get_extent(
+            stylename, geometrytype, additional_filter)
+        if legend.whole_feature == True:
+            self.whole_feature = True
+        return extent
+
+    def _map(self, fn, items):
+        layername = get_layer()
+        def _fn(item):
+            # greenlets don't inherit the layer timings are recorded for
+            set_layer(layername)
+            return fn(item)
+        return Group().map(_fn, items)
+
+
+def run(conf_file_path, concurrency=100, max_requests=8, incremental=False,
+    sprites=None):
+    """Run legend generation for a configuration file in greenlets.
+
+    @param concurrency: number of layers processed concurrently
+    @type concurrency: C{int}
+    @param max_requests: max number of concurrent requests per host
+    @type max_requests: C{int}
+    @param incremental: only rebuild changed legends, see L{legender.run}
+    @type incremental: C{bool}
+    @param sprites: path to write sprite sheets of all legends to, see
+        L{legender.write_run_sprites}
+    """
+    AsyncGeoServer.max_requests = max_requests
+    conf = load_conf(conf_file_path)
+    jobs = build_jobs(conf)
+    manifests = {}
+    if incremental == True:
+        manifests = get_manifests(jobs)
+    def _run_job(job):
+        manifest = manifests.get(job['out_path'], None)
+        files = run_job(job, manifest,
+            cls=AsyncGeoServer, legend_cls=AsyncLegend)
+        if files == None:
+            files = manifest.get_files(job_key(job))
+        return files
+    files = Pool(concurrency).map(_run_job, jobs)
+    write_run_sprites(conf, jobs, files, sprites)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate map legend thumbnails using an event loop.')
+    parser.add_argument('-c', type=str, help="Path to the configuration file")
+    parser.add_argument('-n', '--concurrency', type=int, default=100,
+        help="Number of layers to process concurrently")
+    parser.add_argument('-r', '--max-requests', type=int, default=8,
+        help="Max number of concurrent requests per host")
+    parser.add_argument('-i', '--incremental', action='store_true',
+        help="Only rebuild legends with changed configuration or styles")
+    parser.add_argument('-s', '--sprites', type=str,
+        help="Also pack all legends into sprite sheets at this path")
+    parser.add_argument('--report', type=str,
+        help="Write request and image processing timings to this JSON or "
+            "CSV file")
+    parser.add_argument('--log-level', type=str, default='INFO',
+        help="Logging level (DEBUG, INFO, WARNING or ERROR)")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(),
+        format='%(asctime)s %(levelname)s %(message)s')
+    sprites = args.sprites
+    if sprites != None:
+        sprites = os.path.realpath(sprites)
+    report = args.report
+    if report != None:
+        report = os.path.realpath(report)
+    with reporting(report):
+        run(args.c, args.concurrency, args.max_requests, args.incremental,
+            sprites)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the CPU heavy bits of legend generation.
+
+Run with C{python bench.py}.
+"""
+import math, random, timeit
+
+from PIL import Image, ImageDraw
+
+from legender import GeoServer, Legend
+
+GS_URL = 'http://localhost/geoserver'
+
+def _images(size=(100, 100)):
+    width, height = size
+    blank = Image.new('RGBA', size, (255, 255, 255, 0))
+    black = Image.new('RGB', size, (0, 0, 0))
+    # antialiased like GeoServer renders
+    drawn = Image.new('RGBA', (width * 4, height * 4), (255, 255, 255, 0))
+    ImageDraw.Draw(drawn).ellipse(
+        (width, height, width * 3, height * 3), fill=(200, 30, 30, 255))
+    drawn = drawn.resize(size, Image.ANTIALIAS)
+    return [
+        ('blank', blank), ('black', black),
+        ('drawn', drawn), ('drawn RGB', drawn.convert('RGB'))
+    ]
+
+def bench_is_empty_image(number=2000, sizes=[(100, 100), (256, 256)]):
+    l = Legend(GeoServer, GS_URL, 'black:magic', {})
+    print 'is_empty_image, %s runs (ms)' % number
+    for size in sizes:
+        for name, img in _images(size):
+            assert l.is_empty_image(img) == l._is_empty_image_grayscale(img)
+            fast = timeit.timeit(lambda: l.is_empty_image(img), number=number)
+            slow = timeit.timeit(
+                lambda: l._is_empty_image_grayscale(img), number=number)
+            print '  %sx%s %-10s colors: %8.1f  grayscale: %8.1f' % (
+                size + (name, fast * 1000, slow * 1000))
+
+def _features(n=1000, vertices=50, seed=0):
+    """Random points, lines, polygons and multipolygons in EPSG:3301."""
+    rnd = random.Random(seed)
+    def ring(x, y, r):
+        coords = [
+            [x + r * rnd.uniform(0.5, 1) * math.cos(a),
+                y + r * rnd.uniform(0.5, 1) * math.sin(a)]
+            for a in [2 * math.pi * i / vertices for i in range(vertices)]
+        ]
+        return coords + coords[:1]
+    features = []
+    for i in range(n):
+        x = rnd.uniform(370000, 740000)
+        y = rnd.uniform(6370000, 6640000)
+        r = rnd.uniform(10, 5000)
+        kind = i % 4
+        if kind == 0:
+            g = dict(type='Point', coordinates=[x, y])
+        elif kind == 1:
+            g = dict(type='LineString', coordinates=ring(x, y, r)[:-1])
+        elif kind == 2:
+            g = dict(type='Polygon', coordinates=[ring(x, y, r)])
+        else:
+            g = dict(type='MultiPolygon', coordinates=[
+                [ring(x, y, r)], [ring(x + 3 * r, y, r / 2)]])
+        features.append(dict(type='Feature', geometry=g))
+    return features
+
+def bench_get_bboxes_from_features(number=3, sizes=[100, 1000, 10000]):
+    print 'get_bboxes_from_features, best of %s runs (features/s)' % number
+    for whole_feature in (True, False):
+        l = Legend(GeoServer, GS_URL, 'black:magic',
+            dict(whole_feature=whole_feature))
+        for n in sizes:
+            features = _features(n)
+            single = min(timeit.repeat(
+                lambda: [l.get_bbox_from_feature(f) for f in features],
+                number=1, repeat=number))
+            batch = min(timeit.repeat(
+                lambda: l.get_bboxes_from_features(features),
+                number=1, repeat=number))
+            print '  whole_feature %-5s %6s features  single: %9.0f  batch: %9.0f' % (
+                whole_feature, n, n / single, n / batch)
+
+
+if __name__ == '__main__':
+    bench_is_empty_image()
+    bench_get_bboxes_from_features()
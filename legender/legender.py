@@ -1,22 +1,697 @@
 # -*- coding: utf-8 -*-
-import argparse, json, os, requests
+import argparse, csv, hashlib, json, logging, math, multiprocessing, os, \
+    random, re, requests, sys, threading, time
 
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from PIL import Image, ImageDraw, ImageOps, ImageFont
 from StringIO import StringIO
-from shapely.geometry import asShape, Point, LineString
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from urllib import urlencode
+from xml.etree import ElementTree
+from shapely.geometry import asShape, mapping, Point, LineString
+from shapely.ops import transform
 import textwrap
+try:
+    # optional, for computing bboxes of many features at once
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    # optional, for srs units and reprojection
+    import pyproj
+except ImportError:
+    pyproj = None
+
+log = logging.getLogger('legender')
+
+def load_image(data):
+    """Load an image from encoded image data (e.g PNG as returned by WMS) or
+    from raw data as returned by L{dump_image}.
+    """
+    if isinstance(data, tuple):
+        mode, size, raw = data
+        return Image.frombytes(mode, size, raw)
+    return Image.open(StringIO(data))
+
+def dump_image(img):
+    """Return raw image data, cheap to pass between processes."""
+    return (img.mode, img.size, img.tobytes())
+
+# legend output encoding, see encode_image
+output_defaults = dict(
+    format='png',
+    palette=False,
+    colors=256,
+    optimize=False,
+    compress_level=6,
+    scales=[1]
+)
+
+def encode_image(img, output=None):
+    """Encode an image for output.
+
+    C{output} (see C{output_defaults}) C{format} is either C{png} or
+    lossless C{webp}. PNGs are optionally quantized to a C{palette} of
+    C{colors} (lossy, but a lot smaller), C{optimize} trades time for size.
+    """
+    output = dict(output_defaults, **(output or {}))
+    f = StringIO()
+    if output['format'] == 'webp':
+        img.save(f, 'WEBP', lossless=True, quality=100, method=6)
+    elif output['format'] == 'png':
+        if output['palette'] == True:
+            img = img.quantize(output['colors'], method=Image.FASTOCTREE)
+        img.save(f, 'PNG', optimize=output['optimize'],
+            compress_level=output['compress_level'])
+    else:
+        raise ValueError('Unknown output format %s' % output['format'])
+    return f.getvalue()
+
+
+_masks = {}
+_masks_lock = threading.Lock()
+
+def get_mask(size, shape='circle', linewidth=4, color=(27, 29, 28, 255)):
+    """Return a (cached) thumbnail mask with an outline.
+
+    The mask is drawn 4 times oversized and downsampled for antialiasing.
+
+    @param shape: C{circle} or C{roundrect}
+    @param linewidth: outline width in the oversized mask, i.e 4 gives a
+        1px outline
+    """
+    key = (tuple(size), shape, linewidth, tuple(color))
+    with _masks_lock:
+        if key in _masks:
+            return _masks[key]
+    assert shape in ['circle', 'roundrect'], "'%s' is not a known mask shape" % (
+        shape, )
+    width, height = size
+    # antialias
+    bigsize = (width * 4, height * 4)
+    mask = Image.new('RGBA', bigsize, (255, 255, 255, 255))
+    draw = ImageDraw.Draw(mask)
+    outer = (0, 0) + bigsize
+    inner = (linewidth, linewidth) + (bigsize[0] - linewidth, bigsize[1] - linewidth)
+    if shape == 'circle':
+        draw.ellipse(outer, fill=tuple(color))
+        draw.ellipse(inner, fill=(255, 255, 255, 0))
+    else:
+        radius = min(bigsize) / 5
+        _draw_roundrect(draw, outer, radius, tuple(color))
+        _draw_roundrect(draw, inner, radius - linewidth, (255, 255, 255, 0))
+    mask = mask.resize(tuple(size), Image.ANTIALIAS)
+    with _masks_lock:
+        _masks[key] = mask
+    return mask
+
+def _draw_roundrect(draw, box, radius, fill):
+    x0, y0, x1, y1 = box
+    d = radius * 2
+    draw.rectangle((x0 + radius, y0, x1 - radius, y1), fill=fill)
+    draw.rectangle((x0, y0 + radius, x1, y1 - radius), fill=fill)
+    draw.pieslice((x0, y0, x0 + d, y0 + d), 180, 270, fill=fill)
+    draw.pieslice((x1 - d, y0, x1, y0 + d), 270, 360, fill=fill)
+    draw.pieslice((x0, y1 - d, x0 + d, y1), 90, 180, fill=fill)
+    draw.pieslice((x1 - d, y1 - d, x1, y1), 0, 90, fill=fill)
+
+
+_blank_colors = []
+
+def get_blank_colors():
+    """Return sets of RGB colors PIL converts to black (0) and white (255)
+    grayscale (mode C{L}).
+    """
+    if len(_blank_colors) == 0:
+        # only colors close to black/white qualify, convert all candidates
+        # in one go
+        candidates = [(r, g, b)
+            for r in range(16) for g in range(16) for b in range(16)]
+        candidates += [(255 - r, 255 - g, 255 - b) for r, g, b in candidates]
+        img = Image.new('RGB', (len(candidates), 1))
+        img.putdata(candidates)
+        values = img.convert('L').getdata()
+        black = set([c for c, v in zip(candidates, values) if v == 0])
+        white = set([c for c, v in zip(candidates, values) if v == 255])
+        _blank_colors[:] = [black, white]
+    return _blank_colors
+
+_empty_maps = {}
+_empty_maps_lock = threading.Lock()
+
+def empty_map_key(size, transparent, format='image/png', bgcolor='0xffffff'):
+    """Key for the empty images GeoServer returns for GetMap requests."""
+    return (tuple(size), format, bgcolor, transparent == True)
+
+def map_fingerprint(data):
+    return (len(data), hashlib.sha1(data).hexdigest())
+
+def is_empty_map(key, data):
+    """Is C{data} a known empty GetMap response? (see L{add_empty_map})"""
+    with _empty_maps_lock:
+        fingerprints = _empty_maps.get(key, None)
+        if fingerprints == None:
+            return False
+        # hashing is needed only if the size matches
+        if len(data) not in [length for length, _ in fingerprints]:
+            return False
+    return map_fingerprint(data) in fingerprints
+
+def add_empty_map(key, fingerprint):
+    """Learn a fingerprint (see L{map_fingerprint}) of an empty GetMap
+    response.
+    """
+    with _empty_maps_lock:
+        _empty_maps.setdefault(key, set()).add(tuple(fingerprint))
+
+_fonts = {}
+_labels = {}
+_fonts_lock = threading.Lock()
+
+def get_font(path, size):
+    """Return a (cached) TrueType font."""
+    key = (path, size)
+    with _fonts_lock:
+        if key not in _fonts:
+            _fonts[key] = ImageFont.truetype(path, size)
+        return _fonts[key]
+
+
+# srs assumed to use degrees without pyproj, all others metres
+geographic_srs = set([
+    'CRS:84', 'EPSG:4326', 'EPSG:4258', 'EPSG:4269', 'EPSG:4267',
+    'EPSG:4283', 'EPSG:4674'
+])
+# length of a degree of latitude, roughly
+metres_per_degree = 111320.0
+
+_crs = {}
+_srs_scales = {}
+_transformers = {}
+_crs_lock = threading.Lock()
+
+def normalize_srs(srs):
+    """'urn:ogc:def:crs:EPSG::4326' and alike to 'EPSG:4326'."""
+    parts = srs.upper().split(':')
+    if 'EPSG' in parts:
+        return 'EPSG:%s' % parts[-1]
+    return srs.upper()
+
+def get_crs(srs):
+    """Return a (cached) pyproj CRS."""
+    if pyproj == None:
+        raise ImportError('pyproj is required for reprojection')
+    with _crs_lock:
+        if srs not in _crs:
+            _crs[srs] = pyproj.CRS.from_user_input(srs)
+        return _crs[srs]
+
+def get_srs_scale(srs):
+    """Return (cached) number of C{srs} units in a metre. Units of unknown
+    srs are metres.
+    """
+    if srs == None:
+        return 1.0
+    if srs not in _srs_scales:
+        if pyproj == None:
+            geographic = normalize_srs(srs) in geographic_srs
+            scale = 1.0
+        else:
+            crs = get_crs(srs)
+            geographic = crs.is_geographic
+            scale = 1.0 / crs.axis_info[0].unit_conversion_factor
+        if geographic:
+            scale = 1.0 / metres_per_degree
+        _srs_scales[srs] = scale
+    return _srs_scales[srs]
+
+def get_transformer(src, dst):
+    """Return a (cached) pyproj Transformer (with x/y, i.e lon/lat, axis
+    order) and a lock to use it with from C{src} to C{dst} srs.
+    """
+    key = (src, dst)
+    src_crs, dst_crs = get_crs(src), get_crs(dst)
+    with _crs_lock:
+        if key not in _transformers:
+            # transformers are not safe to be used by threads concurrently
+            _transformers[key] = (pyproj.Transformer.from_crs(
+                src_crs, dst_crs, always_xy=True), threading.Lock())
+        return _transformers[key]
+
+def reproject(shape, src, dst):
+    """Reproject a shapely geometry."""
+    transformer, lock = get_transformer(src, dst)
+    with lock:
+        return transform(transformer.transform, shape)
+
+def reproject_bounds(bounds, src, dst):
+    """Bounds in C{dst} srs of C{bounds} in C{src} srs, edges are sampled
+    to account for curvature.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    xs = [xmin, (xmin + xmax) / 2.0, xmax]
+    ys = [ymin, (ymin + ymax) / 2.0, ymax]
+    transformer, lock = get_transformer(src, dst)
+    with lock:
+        x, y = transformer.transform(
+            [x for x in xs for _ in ys], [y for _ in xs for y in ys])
+    return (min(x), min(y), max(x), max(y))
+
+
+class Report(object):
+    """Timings of HTTP requests and image processing stages (see L{record})
+    collected during a run, with aggregates per request type, server, layer,
+    layer style and stage.
+    """
+    fields = ['kind', 'server', 'layer', 'request', 'style', 'stage',
+        'status', 'error', 'bytes', 'seconds', 'ttfb', 'transfer', 'url']
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, records):
+        with self._lock:
+            self.records.extend(records)
+
+    def summary(self, slowest=10):
+        """Aggregates (count, total and max seconds, bytes) and C{slowest}
+        requests and stages.
+        """
+        requests = [r for r in self.records if r['kind'] == 'request']
+        stages = [r for r in self.records if r['kind'] == 'stage']
+        def aggregate(records, key):
+            groups = {}
+            for r in records:
+                g = groups.setdefault(key(r) or '', dict(
+                    count=0, seconds=0.0, max_seconds=0.0, bytes=0))
+                g['count'] += 1
+                g['seconds'] += r['seconds']
+                g['max_seconds'] = max(g['max_seconds'], r['seconds'])
+                g['bytes'] += r.get('bytes', None) or 0
+            for g in groups.values():
+                g['seconds'] = round(g['seconds'], 3)
+            return groups
+        def slowest_of(records):
+            return sorted(records, key=lambda r: r['seconds'],
+                reverse=True)[:slowest]
+        return dict(
+            requests=aggregate(requests, lambda r: r['request']),
+            servers=aggregate(requests, lambda r: r['server']),
+            layers=aggregate(self.records, lambda r: r['layer']),
+            styles=aggregate(
+                [r for r in requests if r['request'] == 'GetMap'],
+                lambda r: '%s|%s' % (r['layer'], r.get('style', None))),
+            stages=aggregate(stages, lambda r: r['stage']),
+            slowest_requests=slowest_of(requests),
+            slowest_stages=slowest_of(stages)
+        )
+
+    def write(self, path, slowest=10):
+        """Write records to a CSV file, or summary and records to a JSON
+        file (depending on C{path} extension).
+        """
+        with open(path, 'wb') as f:
+            if path.endswith('.csv'):
+                writer = csv.DictWriter(f, self.fields, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(self.records)
+            else:
+                f.write(json.dumps(dict(summary=self.summary(slowest),
+                    records=self.records), indent=1, sort_keys=True))
+
+_report = None
+_context = threading.local()
+
+def set_report(report):
+    """Collect records to C{report} (C{None} for not collecting), return
+    the previous one.
+    """
+    global _report
+    previous, _report = _report, report
+    return previous
+
+def set_layer(layername):
+    """Layer records of the current thread are about."""
+    _context.layer = layername
+
+def get_layer():
+    return getattr(_context, 'layer', None)
+
+def record(**fields):
+    """Record timing of a request (C{kind} C{request}) or stage (C{kind}
+    C{stage}), if a report is being collected (see L{set_report}).
+    """
+    if _report == None:
+        return
+    if fields.get('layer', None) == None:
+        fields['layer'] = get_layer()
+    _report.add([fields])
+
+@contextmanager
+def timed(stage):
+    """Record time taken by an image processing stage."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(kind='stage', stage=stage,
+            seconds=round(time.time() - start, 6))
+
+@contextmanager
+def reporting(path, slowest=10):
+    """Collect a L{Report} of everything done within, written to C{path}
+    (see L{Report.write}) in the end. Nothing is collected without a path.
+    """
+    if path == None:
+        yield None
+        return
+    report = Report()
+    previous = set_report(report)
+    try:
+        yield report
+    finally:
+        set_report(previous)
+        report.write(path, slowest)
+        log.info('Report of %s records written to %s',
+            len(report.records), path)
+
+
+class DiskCache(object):
+    """Simple file-per-key cache living in a directory.
+
+    Values are byte strings. Entries older than C{ttl} seconds are
+    considered stale, C{ttl} of C{None} means entries never expire.
+    """
+    def __init__(self, path, ttl=None):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+        self.path = path
+        self.ttl = ttl
+
+    def _filename(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        fn = self._filename(key)
+        try:
+            if self.ttl != None and time.time() - os.path.getmtime(fn) > self.ttl:
+                return None
+            with open(fn, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def mtime(self, key):
+        """Time an entry was stored, C{None} if there's none."""
+        try:
+            return os.path.getmtime(self._filename(key))
+        except OSError:
+            return None
+
+    def set(self, key, data):
+        # write to a temporary file first so concurrent readers never see
+        # partially written entries
+        fn = self._filename(key)
+        tmp = '%s.%s.%s.tmp' % (
+            fn, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, fn)
+
+
+class LRUCache(object):
+    """Thread-safe in-memory LRU cache, optionally backed by a L{DiskCache}.
+
+    Values found on disk are promoted to memory. Entries older than C{ttl}
+    seconds (since stored, on disk or not) are stale in memory too.
+    """
+    def __init__(self, size=128, path=None, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        # (time stored, value) by key
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        if path != None:
+            self.disk = DiskCache(path, ttl)
+        else:
+            self.disk = None
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                stored, value = self._data.pop(key)
+                if self.ttl == None or time.time() - stored <= self.ttl:
+                    self._data[key] = (stored, value)
+                    return value
+        if self.disk != None:
+            value = self.disk.get(key)
+            if value != None:
+                self._set(key, value, self.disk.mtime(key))
+            return value
+        return None
+
+    def set(self, key, value):
+        self._set(key, value)
+        if self.disk != None:
+            self.disk.set(key, value)
+
+    def __len__(self):
+        """Number of entries in memory."""
+        return len(self._data)
+
+    def _set(self, key, value, stored=None):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (stored or time.time(), value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(name, size=128, path=None, ttl=None):
+    """Return a named L{LRUCache} shared within the process."""
+    key = (name, path)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = LRUCache(size, path, ttl)
+        return _caches[key]
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(url, auth=None, pool_size=10, retries=3, backoff=0.5):
+    """Return a keep-alive, connection-pooled session shared by everyone
+    talking to C{url} with the same C{auth}.
+
+    @param pool_size: max number of pooled connections per host
+    @param retries: number of retries for failed connections and 5xx
+        responses
+    @param backoff: backoff factor between retries (in seconds)
+    """
+    key = (url, auth)
+    with _sessions_lock:
+        if key not in _sessions:
+            session = requests.Session()
+            session.auth = auth
+            retry = Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=(500, 502, 503, 504),
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+                max_retries=retry
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = session
+        return _sessions[key]
+
+
+def feature_size(feature):
+    """Area of a polygon, length of a line feature, 0 for points."""
+    shape = asShape(feature['geometry'])
+    if shape.area > 0:
+        return shape.area
+    return shape.length
+
+def sample_first(features, seed=None, n=5):
+    """Whatever feature the server returned first."""
+    return features[0]
+
+def sample_largest(features, seed=None, n=5):
+    return max(features, key=feature_size)
+
+def sample_median(features, seed=None, n=5):
+    features = sorted(features, key=feature_size)
+    return features[len(features) // 2]
+
+def sample_random(features, seed=None, n=5):
+    """Largest of C{n} features picked at random (reproducible with
+    C{seed})."""
+    rnd = random.Random(seed)
+    return sample_largest(rnd.sample(features, min(n, len(features))))
+
+# representative feature sampling strategies by name
+sampling_strategies = dict(
+    first=sample_first,
+    largest=sample_largest,
+    median=sample_median,
+    random=sample_random
+)
+
 
 class GeoServer(object):
+    map_format = 'image/png'
+    #map_bgcolor = '0xF9F5F4'
+    map_bgcolor = '0xffffff'
+    geometrytypes = ['Point', 'LineString', 'Polygon']
+    # GML geometry types (as in DescribeFeatureType localType) mapped to
+    # geometry types known by construct_cql_for_geometrytype
+    gml_geometrytypes = {
+        'Point': 'Point',
+        'MultiPoint': 'Point',
+        'LineString': 'LineString',
+        'LinearRing': 'LineString',
+        'Curve': 'LineString',
+        'MultiLineString': 'LineString',
+        'MultiCurve': 'LineString',
+        'Polygon': 'Polygon',
+        'Surface': 'Polygon',
+        'MultiPolygon': 'Polygon',
+        'MultiSurface': 'Polygon'
+    }
+
     def __init__(self, url, **kwargs):
-        self.session = requests.Session()
+        auth = None
         if "username" in kwargs and kwargs['username'] != None:
             _user = kwargs.pop("username")
             _pass = kwargs.pop("password")
-            self.session.auth = (_user, _pass)
+            auth = (_user, _pass)
         self.url = url.rstrip('/')
+        self.transport = kwargs.get('transport', None) or {}
+        self.session = get_session(self.url, auth, **self.transport)
+        # preflight checks results by layername, optionally backed by disk
+        self._preflight = {}
+        # concurrent preflight checks of a layer wait for the first one
+        self._preflight_locks = {}
+        self._lock = threading.Lock()
+        self._geometrytypes = {}
+        preflight_cache = kwargs.get('preflight_cache', None)
+        if preflight_cache != None:
+            self.preflight_cache = DiskCache(
+                preflight_cache['path'], preflight_cache.get('ttl', None))
+        else:
+            self.preflight_cache = None
+        # responses with validators, for conditional requests
+        http_cache = kwargs.get('http_cache', None)
+        if http_cache != None:
+            self.http_cache = DiskCache(
+                http_cache['path'], http_cache.get('ttl', None))
+        else:
+            self.http_cache = None
+        # WMS capabilities are shared by all instances, optionally on disk
+        self.capabilities_cache = get_cache('capabilities',
+            **(kwargs.get('capabilities_cache', None) or {}))
+
+    def get_capabilities(self, workspace=None):
+        """Return layers from (cached) WMS GetCapabilities of a workspace.
 
-    def get_feature(self, layername, geometrytype, additional_filter=None):
-        """Query for a sample feature of from WFS endpoint"""
+        Parsed layer info is kept in memory as long as the document is the
+        same, and shared by all callers, so it's not to be modified.
+
+        @return: C{dict} of layer info (C{title}, C{styles}, C{srs} and
+            C{bbox} in native srs, C{latlonbbox}) by workspace qualified
+            layername
+        """
+        url = self.service_url(workspace)
+        params = dict(
+            service='WMS',
+            request='GetCapabilities',
+            version='1.1.1'
+        )
+        key = '%s?%s' % (url, urlencode(sorted(params.items())))
+        data = self.capabilities_cache.get(key)
+        if data == None:
+            data = self._do_query('content', url, **params)
+            self.capabilities_cache.set(key, data)
+        parsed = get_cache('parsed_capabilities').get(key)
+        # usually the very same string from memory, compared in no time
+        if parsed != None and parsed[0] == data:
+            return parsed[1]
+        layers = self.parse_capabilities(data, workspace)
+        get_cache('parsed_capabilities').set(key, (data, layers))
+        return layers
+
+    def parse_capabilities(self, data, workspace=None):
+        """Get layer info from WMS 1.1.1 GetCapabilities document."""
+        def bbox(el):
+            return [float(el.get(c)) for c in ['minx', 'miny', 'maxx', 'maxy']]
+        layers = {}
+        root = ElementTree.fromstring(data)
+        for layer in root.iter('Layer'):
+            name = layer.findtext('Name')
+            if name == None:
+                continue
+            if workspace != None and ':' not in name:
+                # virtual services list layers without workspace
+                name = '%s:%s' % (workspace, name)
+            info = dict(
+                title=layer.findtext('Title'),
+                styles=[s.findtext('Name') for s in layer.findall('Style')],
+                srs=None,
+                bbox=None,
+                latlonbbox=None
+            )
+            # layer's own bbox is in native srs
+            bb = layer.find('BoundingBox')
+            if bb != None:
+                info['srs'] = bb.get('SRS')
+                info['bbox'] = bbox(bb)
+            elif layer.find('SRS') != None:
+                info['srs'] = layer.findtext('SRS').split()[0]
+            llbb = layer.find('LatLonBoundingBox')
+            if llbb != None:
+                info['latlonbbox'] = bbox(llbb)
+            layers[name] = info
+        return layers
+
+    def get_styles(self, layername):
+        """Return names of all styles of a layer from WMS capabilities."""
+        workspace, _ = self.split_layername(layername)
+        info = self.get_capabilities(workspace).get(layername, None)
+        if info == None or len(info['styles']) == 0:
+            return ['default']
+        return info['styles']
+
+    def get_feature(self, layername, geometrytype, additional_filter=None,
+        geometry_only=False):
+        """Query for a sample feature of from WFS endpoint
+
+        @param geometry_only: query for the geometry property only, without
+            any attributes
+        """
+        features = self.get_features(layername, geometrytype,
+            additional_filter, 1, geometry_only)
+        if len(features) == 0:
+            return None
+        return features[0]
+
+    def get_features(self, layername, geometrytype, additional_filter=None,
+        count=1, geometry_only=False):
+        """Query for up to C{count} sample features from WFS endpoint."""
         workspace, _ = self.split_layername(layername)
         geometry_name = self.do_preflight_checks(workspace, layername)
         cql_filter = self.construct_cql_for_geometrytype(
@@ -24,21 +699,65 @@ class GeoServer(object):
         cql_filter = self.add_additional_filter(cql_filter, additional_filter)
         params = dict(
             typename=layername,
-            count=1,
+            count=count,
             cql_filter=cql_filter
         )
+        if geometry_only == True and geometry_name != None:
+            params['propertyName'] = geometry_name
         fc = self._do_wfs_get_feature(workspace, **params)
-        features = fc['features']
-        if len(features) == 0:
-            return None
-        feature = features[0]
-        return feature
+        return fc['features']
+
+    def get_geometry_types(self, layername):
+        """Discover geometry types a layer contains with a single WFS
+        DescribeFeatureType request.
+
+        Layers with a generic geometry property (e.g C{Geometry}) or without
+        a WFS endpoint may contain any of the known geometry types.
+        """
+        if layername in self._geometrytypes:
+            return self._geometrytypes[layername]
+        workspace, _ = self.split_layername(layername)
+        try:
+            description = self._do_wfs_describe_feature_type(
+                workspace, typename=layername)
+        except ValueError:
+            geometrytypes = list(self.geometrytypes)
+        else:
+            geometrytypes = self.parse_geometry_types(description)
+        self._geometrytypes[layername] = geometrytypes
+        return geometrytypes
+
+    def parse_geometry_types(self, description):
+        """Get geometry types from a JSON DescribeFeatureType response."""
+        properties = []
+        for featuretype in description.get('featureTypes', []):
+            properties.extend([
+                p for p in featuretype.get('properties', [])
+                if p.get('type', '').startswith('gml:')
+            ])
+        found = set()
+        for p in properties:
+            gt = self.gml_geometrytypes.get(p.get('localType'), None)
+            if gt == None:
+                # generic geometry, anything goes
+                return list(self.geometrytypes)
+            found.add(gt)
+        if len(found) == 0:
+            return list(self.geometrytypes)
+        return [gt for gt in self.geometrytypes if gt in found]
 
     def get_map(self, layername, geometrytype, geometryname, bbox, srs,
         transparent=True, additional_filter=None, featureid=None,
         style='default', size=(100, 100), geometrytype_filtering=True,
-        bckground_conf=None):
-        """Query WMS endpoint for a piece of map layer to be used for legend."""
+        bckground_conf=None, decode=True, dpi=None):
+        """Query WMS endpoint for a piece of map layer to be used for legend.
+
+        @param decode: return images, or with C{False} the image data as
+            returned by the server. Known empty images (see L{is_empty_map})
+            are then returned as C{None}.
+        @param dpi: render at this resolution (GeoServer's default is 90),
+            for symbols scaled with image size
+        """
         workspace, _ = self.split_layername(layername)
         if featureid != None:
             cql_filter = None
@@ -56,13 +775,21 @@ class GeoServer(object):
             featureid=featureid,
             style=style,
             width=width,
-            height=height
+            height=height,
+            format_options=dpi and 'dpi:%s' % dpi
         )
         data = self._do_wms_get_map(workspace, **params)
-        img = Image.open(StringIO(data))
+        if decode == False and is_empty_map(self.empty_map_key(size, transparent), data):
+            return None, None
         if bckground_conf != None:
-            data = self.get_background(bckground_conf, srs, bbox, size)
-            bck = Image.open(StringIO(data))
+            bck_data = self.get_background(bckground_conf, srs, bbox, size)
+        else:
+            bck_data = None
+        if decode == False:
+            return data, bck_data
+        img = load_image(data)
+        if bck_data != None:
+            bck = load_image(bck_data)
         else:
             bck = None
         #bck.convert('RGBA')
@@ -72,6 +799,88 @@ class GeoServer(object):
         #return bck
         return img, bck
 
+    def get_mosaic(self, layername, extents, srs, transparent=True,
+        additional_filter=None, style='default', size=(100, 100),
+        bckground_conf=None, max_size=2048, decode=True, dpi=None):
+        """Query WMS endpoint for thumbnails of several geometry types with a
+        single GetMap request.
+
+        The layer is repeated once per geometry type with a CQL filter of its
+        own, rendered over the union of all extents and cropped into
+        thumbnails client side. Crops are never resampled (symbols would
+        shrink), so extents must all be of the same resolution.
+
+        @param extents: list of C{(geometrytype, geometryname, bbox)}
+        @param decode: return images, or with C{False} image data to be
+            loaded with L{load_image}.
+        @return: list of C{(img, bck)} in the order of C{extents}, or
+            C{None} if a mosaic can't be used (resolutions differ by more
+            than a pixel, too large an image or C{;} in filters).
+        """
+        workspace, _ = self.split_layername(layername)
+        width, height = size
+        cql_filters = []
+        for geometrytype, geometryname, bbox in extents:
+            cql_filter = self.construct_cql_for_geometrytype(
+                geometrytype, geometryname)
+            cql_filter = self.add_additional_filter(cql_filter, additional_filter)
+            cql_filters.append(cql_filter or 'INCLUDE')
+        if len([f for f in cql_filters if ';' in f]) > 0:
+            # GeoServer separates per layer filters with ';'
+            return None
+        res = min([
+            max((bbox[2] - bbox[0]) / float(width),
+                (bbox[3] - bbox[1]) / float(height))
+            for _, _, bbox in extents
+        ])
+        for _, _, bbox in extents:
+            if abs((bbox[2] - bbox[0]) / res - width) > 1 or \
+                abs((bbox[3] - bbox[1]) / res - height) > 1:
+                return None
+        minx = min([bbox[0] for _, _, bbox in extents])
+        miny = min([bbox[1] for _, _, bbox in extents])
+        maxx = max([bbox[2] for _, _, bbox in extents])
+        maxy = max([bbox[3] for _, _, bbox in extents])
+        mosaic_width = int(math.ceil((maxx - minx) / res))
+        mosaic_height = int(math.ceil((maxy - miny) / res))
+        if mosaic_width > max_size or mosaic_height > max_size:
+            return None
+        # align mosaic extent with the pixel grid
+        maxx = minx + mosaic_width * res
+        maxy = miny + mosaic_height * res
+        n = len(extents)
+        params = dict(
+            layers=','.join([layername] * n),
+            bbox=','.join(['%s' % coord for coord in (minx, miny, maxx, maxy)]),
+            srs=srs,
+            transparent=transparent,
+            cql_filter=';'.join(cql_filters),
+            style=style,
+            width=mosaic_width,
+            height=mosaic_height,
+            format_options=dpi and 'dpi:%s' % dpi
+        )
+        data = self._do_wms_get_map(workspace, **params)
+        mosaic = Image.open(StringIO(data)).convert('RGBA')
+        images = []
+        for _, _, bbox in extents:
+            left = int(round((bbox[0] - minx) / res))
+            top = int(round((maxy - bbox[3]) / res))
+            img = mosaic.crop((left, top, left + width, top + height))
+            if bckground_conf != None:
+                bck = self.get_background(bckground_conf, srs, bbox, size)
+            else:
+                bck = None
+            if decode == False:
+                images.append((dump_image(img), bck))
+            else:
+                images.append((img, bck and load_image(bck)))
+        return images
+
+    def empty_map_key(self, size, transparent):
+        return empty_map_key(
+            size, transparent, self.map_format, self.map_bgcolor)
+
     def get_background(self, bckground_conf, srs, bbox, size):
         #url = 'http://kaart.maaamet.ee/wms/fotokaart'
         width, height = size
@@ -89,15 +898,50 @@ class GeoServer(object):
             "height":height,
             "transparent":True
         }
-        r = requests.get(
-            url,
-            params=params
-        )
-        print r.url
+        # same background is often requested for several styles/filters
+        cache = get_cache('background', **bckground_conf.get('cache', {}))
+        key = '%s?%s' % (url, urlencode(sorted(params.items())))
+        data = cache.get(key)
+        if data != None:
+            return data
+        session = get_session(url, **self.transport)
+        r = self._get(url, session=session, request='background',
+            params=params)
         r.raise_for_status()
+        cache.set(key, r.content)
         return r.content
 
 
+    def get_style_fingerprint(self, layername, style='default'):
+        """Return a hash of the SLD in use for a layer's style.
+
+        Named styles are fetched from the REST API (workspace styles first),
+        the default style of a layer through WMS GetStyles. Returns C{None}
+        if the SLD could not be fetched.
+        """
+        workspace, _ = self.split_layername(layername)
+        if style == 'default':
+            params = dict(
+                service='WMS',
+                request='GetStyles',
+                version='1.1.1',
+                layers=layername
+            )
+            urls = [(self.service_url(workspace), params)]
+        else:
+            urls = [
+                ('%s/rest/workspaces/%s/styles/%s.sld' % (
+                    self.url, workspace, style), {}),
+                ('%s/rest/styles/%s.sld' % (self.url, style), {})
+            ]
+            if workspace == None:
+                urls = urls[1:]
+        for url, params in urls:
+            r = self._get(url, params=params)
+            if r.status_code == 200:
+                return hashlib.sha1(r.content).hexdigest()
+        return None
+
     def add_additional_filter(self, cql_filter, additional_filter):
         if additional_filter == None:
             return cql_filter
@@ -132,8 +976,10 @@ class GeoServer(object):
         a. is WFS supported?
         b. does the layer contain any features?
         c. what's the geom property name?
+
+        Results are cached per layer, so WFS is queried only once.
         """
-        preflight_check = self.do_preflight_wfs(workspace, layername)
+        preflight_check = self.get_preflight(workspace, layername)
         assert preflight_check['wfs_available'] == True, "WFS endpoint not available"
         if preflight_check['features_present'] == False:
             raise IOError(
@@ -141,6 +987,31 @@ class GeoServer(object):
             )
         return preflight_check['geometry_name']
 
+    def get_preflight(self, workspace, layername):
+        """Return cached pre-flight WFS checks, query them if not cached.
+
+        Concurrent calls for a layer query them only once.
+        """
+        with self._lock:
+            lock = self._preflight_locks.setdefault(
+                layername, threading.Lock())
+        with lock:
+            if layername in self._preflight:
+                return self._preflight[layername]
+            key = 'preflight:%s:%s' % (self.url, layername)
+            preflight_check = None
+            if self.preflight_cache != None:
+                data = self.preflight_cache.get(key)
+                if data != None:
+                    preflight_check = json.loads(data)
+            if preflight_check == None:
+                preflight_check = self.do_preflight_wfs(workspace, layername)
+                if self.preflight_cache != None:
+                    self.preflight_cache.set(
+                        key, json.dumps(preflight_check))
+            self._preflight[layername] = preflight_check
+            return preflight_check
+
     def do_preflight_wfs(self, workspace, layername):
         """Request data for pre-flight WFS checks"""
         params = dict(
@@ -199,6 +1070,18 @@ class GeoServer(object):
         kwargs.update(params)
         return self._do_query('json', url, **kwargs)
 
+    def _do_wfs_describe_feature_type(self, workspace, **kwargs):
+        """Prepare and submit a DescribeFeatureType HTTP Get query."""
+        url = self.service_url(workspace)
+        params = dict(
+            service='WFS',
+            request='DescribeFeatureType',
+            version='2.0.0',
+            outputFormat='application/json',
+        )
+        kwargs.update(params)
+        return self._do_query('json', url, **kwargs)
+
     def _do_wms_get_map(self, workspace, **kwargs):
         """Prepare and submit a GetMap HTTP Get query."""
         url = self.service_url(workspace)
@@ -206,10 +1089,8 @@ class GeoServer(object):
             service='WMS',
             request='GetMap',
             version='1.1.0',
-            format='image/png',
-            #bgcolor='0xF9F5F4'
-            bgcolor='0xffffff'
-
+            format=self.map_format,
+            bgcolor=self.map_bgcolor
         )
         kwargs.update(params)
         return self._do_query('content', url, **kwargs)
@@ -221,14 +1102,16 @@ class GeoServer(object):
             on the returned data (e.g. C{json}, C{xml}, C{text}, etc).
         @type returns: C{str}
         """
-        r = self.session.get(
-            url,
-            params=kwargs
-        )
+        if self.http_cache != None:
+            r = self._do_conditional_get(url, kwargs)
+        else:
+            r = self._get(
+                url,
+                params=kwargs
+            )
         r.raise_for_status()
         fn = getattr(r, returns)
         try:
-            print r.url
             if callable(fn):
                 return fn()
             return fn
@@ -239,15 +1122,180 @@ class GeoServer(object):
                 ))
         return response
 
+    def _do_conditional_get(self, url, params):
+        """Do a HTTP GET query revalidating a previously cached response
+        with C{If-None-Match}/C{If-Modified-Since}.
+
+        On C{304 Not Modified} the cached content is used as the response
+        content.
+        """
+        key = '%s?%s' % (url, urlencode(sorted(
+            [(k, v) for k, v in params.items() if v != None])))
+        cached = self.http_cache.get(key)
+        headers = {}
+        if cached != None:
+            meta, content = cached.split('\n', 1)
+            meta = json.loads(meta)
+            if meta.get('etag') != None:
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified') != None:
+                headers['If-Modified-Since'] = meta['last_modified']
+        r = self._get(
+            url,
+            params=params,
+            headers=headers
+        )
+        if r.status_code == 304 and cached != None:
+            r.status_code = 200
+            r._content = content
+        elif r.status_code == 200:
+            meta = dict(
+                etag=r.headers.get('ETag', None),
+                last_modified=r.headers.get('Last-Modified', None)
+            )
+            if meta['etag'] != None or meta['last_modified'] != None:
+                self.http_cache.set(
+                    key, '%s\n%s' % (json.dumps(meta), r.content))
+        return r
+
+    def _get(self, url, session=None, request=None, **kwargs):
+        """HTTP GET with C{session} (this server's by default), logged and
+        recorded (see L{record}).
+
+        Time to first byte (including connecting) and transfer time of
+        the response body are recorded separately.
+
+        @param request: what's requested, by default the C{request}
+            parameter (e.g C{GetMap}) or C{REST}
+        """
+        params = kwargs.get('params', None) or {}
+        if request == None:
+            request = params.get('request', 'REST')
+        # backgrounds are of other layers, recorded for the current one
+        layer = None
+        if request != 'background':
+            layer = params.get('layers', None) or \
+                params.get('typename', None)
+        fields = dict(kind='request', server=self.url, request=request,
+            layer=layer and layer.split(',')[0], style=params.get('style'))
+        start = time.time()
+        try:
+            r = (session or self.session).get(url, **kwargs)
+            content = r.content
+        except requests.RequestException as e:
+            record(error=e.__class__.__name__, url=url,
+                seconds=round(time.time() - start, 6), **fields)
+            raise
+        seconds = time.time() - start
+        ttfb = r.elapsed.total_seconds()
+        log.info('%s %s (%s bytes, %.3f s)',
+            r.status_code, r.url, len(content), seconds)
+        record(status=r.status_code, bytes=len(content), url=r.url,
+            seconds=round(seconds, 6), ttfb=round(ttfb, 6),
+            transfer=round(max(seconds - ttfb, 0), 6), **fields)
+        return r
+
+
+def _ragged(parts):
+    """Concatenate coordinate lists of C{parts} into a single array.
+
+    @return: points, part index of every point and whether every segment
+        (between consecutive points) lies within a single part
+    """
+    arrays = [numpy.asarray(p, dtype=float)[:, :2] for p in parts]
+    pts = numpy.concatenate(arrays)
+    part = numpy.repeat(numpy.arange(len(arrays)), [len(a) for a in arrays])
+    return pts, part, part[1:] == part[:-1]
+
+def _midpoints(lines):
+    """Points at half length of C{lines}, i.e
+    C{LineString.interpolate(0.5, normalized=True)} for all of them at once.
+    """
+    pts, part, same = _ragged(lines)
+    n = len(lines)
+    d = pts[1:] - pts[:-1]
+    seglen = numpy.hypot(d[:, 0], d[:, 1]) * same
+    # length of all segments before a segment
+    before = numpy.concatenate([[0.], numpy.cumsum(seglen)])
+    start = numpy.searchsorted(part, numpy.arange(n))
+    total = numpy.bincount(part[:-1], seglen, n)
+    half = before[start] + total / 2
+    # first segment of a line reaching half of it's length
+    seg = numpy.maximum(numpy.searchsorted(before[1:], half), start)
+    length = seglen[seg]
+    frac = (half - before[seg]) / numpy.where(length > 0, length, 1.)
+    mid = pts[seg] + frac[:, None] * d[seg]
+    return numpy.where((total > 0)[:, None], mid, pts[start])
+
+def _centroids(parts, owners, signs, n, dim):
+    """Centroids and bounds' upper right corners of C{n} geometries made of
+    C{parts}, i.e C{shape.centroid} and C{shape.bounds} for all of them at
+    once.
+
+    @param owners: geometry index of every part, in ascending order
+    @param signs: 1 for polygon shells, -1 for holes
+    @param dim: 0 for points, 1 for lines and 2 for polygon rings
+    @return: centroids, upper right corners and weights (number of points,
+        length or area) of geometries
+    """
+    pts, part, same = _ragged(parts)
+    owner = numpy.asarray(owners)[part]
+    start = numpy.searchsorted(owner, numpy.arange(n))
+    upper = numpy.maximum.reduceat(pts, start)
+    # relative to the first point of a geometry, for precision
+    origin = pts[start]
+    p = pts - origin[owner]
+    if dim == 0:
+        weight = numpy.bincount(owner, minlength=n).astype(float)
+        moments = [numpy.bincount(owner, p[:, i], n) for i in (0, 1)]
+    else:
+        p0, p1 = p[:-1], p[1:]
+        if dim == 1:
+            d = p1 - p0
+            w = numpy.hypot(d[:, 0], d[:, 1]) * same
+            m = (p0 + p1) / 2 * w[:, None]
+        else:
+            cross = (p0[:, 0] * p1[:, 1] - p1[:, 0] * p0[:, 1]) * same
+            area = numpy.bincount(part[:-1], cross, len(parts))
+            # shells count positive, holes negative whatever the orientation
+            cross *= (numpy.asarray(signs) * numpy.sign(area))[part[:-1]]
+            w = cross / 2
+            m = (p0 + p1) / 6 * cross[:, None]
+        weight = numpy.bincount(owner[:-1], w, n)
+        moments = [numpy.bincount(owner[:-1], m[:, i], n) for i in (0, 1)]
+    centroid = origin + numpy.column_stack(moments) / numpy.where(
+        weight != 0, weight, 1.)[:, None]
+    return centroid, upper, weight
+
 
 class Legend(object):
     font = '/usr/share/fonts/truetype/oxygen/Oxygen-Sans-Bold.ttf'
-    def __init__(self, cls, url, layername=None, conf={}, **kwargs):
-        self._gutter = 10
+    def __init__(self, cls, url, layername=None, conf={}, pool=None,
+        sample_index=None, **kwargs):
         self._thumbs = []
+        # where to write thumbnails as soon as they're final, see stream_to
+        self._stream = None
+        self._files = []
+        self.bboxes = []
+        # optional multiprocessing.Pool for image processing
+        self.pool = pool
+        # representative features chosen in earlier runs
+        if sample_index != None:
+            self.sample_index = DiskCache(
+                sample_index['path'], sample_index.get('ttl', None))
+        else:
+            self.sample_index = None
+        self.server_cls = cls
         self.server = cls(url, **kwargs)
         self.update_conf(layername, conf)
 
+    def __getstate__(self):
+        # only image processing is done in other processes, there's no need
+        # for the server (and it's sessions), pool or images
+        state = self.__dict__.copy()
+        state.update(server=None, pool=None, _thumbs=[], _files=[])
+        return state
+
     def update_conf(self, layername, conf):
         self.layername = layername
         self.title = conf.get('title', layername)
@@ -259,8 +1307,35 @@ class Legend(object):
         # unless we dive into WMS Capabilities, brrrrr....
         self.filename = conf.get('filename', None)
         self.whole_feature = conf.get('whole_feature', True)
+        # only the geometry of a sample feature is needed for bbox
+        self.geometry_only = conf.get('geometry_only', True)
+        # metres around a point or line sample feature, optionally
+        # computed in a metric srs
+        self.buffer_size = conf.get('buffer_size', 500)
+        self.metric_srs = conf.get('metric_srs', None)
+        # how to choose a representative feature among sample_count ones
+        self.sampling = conf.get('sampling', 'first')
+        self.sample_count = conf.get('sample_count', 50)
+        self.sample_seed = conf.get('sample_seed', 0)
+        # number of features picked at random to choose from
+        self.sample_random_n = conf.get('sample_random_n', 5)
+        assert self.sampling in sampling_strategies, \
+            "'%s' is not a known sampling strategy: [%s]" % (
+                self.sampling, ','.join(sorted(sampling_strategies)))
         self.background = conf.get('background', None)
-        self._size = conf.get("size", (50, 50))
+        # render at a multiple of size (e.g 2 for high-DPI screens)
+        self.scale = conf.get('scale', 1)
+        self._size = tuple([int(v * self.scale)
+            for v in conf.get("size", (50, 50))])
+        self._gutter = int(10 * self.scale)
+        # render all geometry types of a style with a single GetMap
+        self.mosaic = conf.get('mosaic', False)
+        self.mosaic_max_size = conf.get('mosaic_max_size', 2048)
+        # thumbnail mask shape (circle, roundrect or none) and outline
+        self.mask = conf.get('mask', 'circle')
+        self.mask_linewidth = int(conf.get('mask_linewidth', 4) * self.scale)
+        self.mask_color = conf.get('mask_color', (27, 29, 28, 255))
+        self.font = conf.get('font', None) or Legend.font
 
     def create_thumbnails(self, add_label=False):
         """Get and merge thumbnails for this configuration.
@@ -269,71 +1344,234 @@ class Legend(object):
         """
         _filter = self.filter or ''
         _filename = self.filename or _filter[:100]
-        for stylename in self.styles:
+        results = []
+        for stylename in self.get_styles():
             parts = [
                 ''.join([s for s in self.layername if s not in ';.,']),
                 ''.join([s for s in _filename if s not in ';:.,"\'_ ']),
                 ''.join([s for s in stylename if s not in ';:.,_'])
             ]
             filename = '%s.png' % ('__'.join([p for p in parts if p != '']), )
-            thumbs = []
-            for geometrytype in ['Point', 'LineString', 'Polygon']:
-                try:
-                    thumb, bck = self._create_thumbnail(
-                        stylename, geometrytype, self.filter
-                    )
-                except AssertionError as ae:
-                    pass
-                else:
-                    if not self.is_empty_image(thumb):
-                        if bck != None:
-                            bck.paste(thumb, (0,0), thumb)
-                            thumb = bck
-                        thumb = self.apply_mask(thumb)
-                        thumbs.append(thumb)
-            img = self.merge_thumbnails(thumbs, add_label)
+            images = self._create_thumbnails(stylename, self.filter)
+            if self.pool != None:
+                # process images while fetching the next style
+                results.append((filename, self.pool.apply_async(
+                    _process_thumbnails, (self, images, add_label))))
+            else:
+                self.add_thumb(filename,
+                    self.process_thumbnails(images, add_label))
+        while len(results) > 0:
+            filename, result = results.pop(0)
+            img, learned, records = result.get()
+            for key, fingerprint in learned:
+                add_empty_map(key, fingerprint)
             if img != None:
-                #img.save(os.path.join(path, filename), "PNG")
-                self._thumbs.append({filename:img})
+                self.add_thumb(filename, load_image(img))
+            # stage timings from the other process
+            if _report != None:
+                _report.add(records)
+
+    def stream_to(self, path, filename=None, title=None, group=False,
+        output=None):
+        """Write thumbnails as soon as they're final instead of keeping
+        them until L{save} (which is then to be called without arguments).
 
-    def save(self, path, filename=None, title=None, group=False):
-        if len(self._thumbs) == 0:
+        Thumbnails to be grouped are kept encoded (i.e compressed) until
+        then, so only images being processed are kept decoded.
+        """
+        self._stream = dict(path=path, filename=filename, title=title,
+            group=group, output=output)
+        self._files = []
+
+    def add_thumb(self, filename, img):
+        """Add a final thumbnail (C{None} for no thumbnail)."""
+        if img == None:
             return
-        if group == False:
-            for d in self._thumbs:
-                filename = d.keys()[0]
-                thumb = d.values()[0]
-                if title != None:
-                    thumb = self.merge_thumbnails(
-                        [thumb], stack='vertical',
-                        add_label=True, labeltext=title)
-                thumb.save(os.path.join(path, filename))
+        if self._stream == None:
+            self._thumbs.append({filename: img})
+        elif self._stream['group'] == True:
+            self._thumbs.append({filename: encode_image(
+                img, dict(compress_level=1))})
         else:
-            _thumbs = []
-            for d in self._thumbs:
-                _thumbs.append(d.values()[0])
-            has_label = title != None
-            img = self.merge_thumbnails(_thumbs, stack='vertical',
+            self._files.extend(self._save_thumb(self._stream['path'],
+                filename, img, self._stream['title'], self._stream['output']))
+
+    def process_thumbnails(self, images, add_label=False, learned=None):
+        """Make thumbnails out of fetched image data and merge them.
+
+        Fingerprints of empty GetMap responses are learned, so they can be
+        recognized without decoding next time (see L{is_empty_map}).
+
+        @param images: list of C{(img, bck)} image data, see L{load_image}.
+            Known empty images are C{None}.
+        @param learned: list to append learned C{(key, fingerprint)} to
+        """
+        thumbs = []
+        for data, bck_data in images:
+            if data == None:
+                continue
+            thumb = load_image(data)
+            if self.is_empty_image(thumb):
+                if not isinstance(data, tuple):
+                    key = empty_map_key(thumb.size, self.background != None,
+                        self.server_cls.map_format, self.server_cls.map_bgcolor)
+                    fingerprint = map_fingerprint(data)
+                    add_empty_map(key, fingerprint)
+                    if learned != None:
+                        learned.append((key, fingerprint))
+            else:
+                if bck_data != None:
+                    bck = load_image(bck_data)
+                    bck.paste(thumb, (0,0), thumb)
+                    thumb = bck
+                with timed('mask'):
+                    thumb = self.apply_mask(thumb)
+                thumbs.append(thumb)
+        with timed('merge'):
+            return self.merge_thumbnails(thumbs, add_label)
+
+    def get_styles(self):
+        """Styles to create thumbnails for, C{all} means all styles of the
+        layer (as in WMS capabilities).
+        """
+        if self.styles == 'all':
+            return self.server.get_styles(self.layername)
+        return self.styles
+
+    def get_geometry_types(self):
+        """Geometry types to create thumbnails for.
+
+        Layers queried through WFS are asked for their geometry types
+        upfront, so only the types actually present are requested. With a
+        preset C{bbox} there's no geometry name to filter by, so a single
+        unfiltered thumbnail (geometry type C{None}) is made.
+        """
+        if self.bbox != None:
+            return [None]
+        return self.server.get_geometry_types(self.layername)
+
+    def save(self, path=None, filename=None, title=None, group=False,
+        output=None):
+        """Save thumbnails, return a list of paths of saved files.
+
+        After L{stream_to} arguments given there are used, and only grouped
+        thumbnails are left to be saved.
+
+        @param output: output encoding configuration, see L{write_image}
+        """
+        files = []
+        if self._stream != None:
+            files = self._files
+            path, filename, title, group, output = [self._stream[k]
+                for k in ('path', 'filename', 'title', 'group', 'output')]
+            self._stream, self._files = None, []
+        if group == True:
+            img = self.merge_group(title)
+            if img == None:
+                return files
+            return files + self.write_image(img, path, filename, output)
+        thumbs, self._thumbs = self._thumbs, []
+        while len(thumbs) > 0:
+            d = thumbs.pop(0)
+            files.extend(self._save_thumb(
+                path, d.keys()[0], d.values()[0], title, output))
+        return files
+
+    def merge_group(self, title=None):
+        """Merge all thumbnails (and forget them) into a single image, as
+        saved for grouped layers. C{None} if there are no thumbnails.
+        """
+        thumbs, self._thumbs = self._thumbs, []
+        if len(thumbs) == 0:
+            return None
+        _thumbs = []
+        for d in thumbs:
+            thumb = d.values()[0]
+            if not isinstance(thumb, Image.Image):
+                thumb = load_image(thumb)
+            _thumbs.append(thumb)
+        del thumbs
+        has_label = title != None
+        with timed('merge'):
+            return self.merge_thumbnails(_thumbs, stack='vertical',
                 add_label=has_label, labeltext=title)
-            img.save(os.path.join(path, filename), "PNG")
+
+    def finish_thumb(self, thumb, title=None):
+        """Final image of a thumbnail, as saved for not grouped layers."""
+        if title != None:
+            with timed('merge'):
+                thumb = self.merge_thumbnails(
+                    [thumb], stack='vertical',
+                    add_label=True, labeltext=title)
+        return thumb
+
+    def _save_thumb(self, path, filename, thumb, title=None, output=None):
+        return self.write_image(
+            self.finish_thumb(thumb, title), path, filename, output)
+
+    def write_image(self, img, path, filename, output=None):
+        """Encode (see L{encode_image}) and write an image in every
+        configured scale, return a list of paths of written files.
+
+        The image is expected to be rendered at C{scale}, other scales are
+        resampled from it and written with a C{@<scale>x} filename suffix.
+        """
+        output = dict(output_defaults, **(output or {}))
+        name, _ = os.path.splitext(filename)
+        files = []
+        for scale in output['scales']:
+            with timed('save'):
+                _img = img
+                if scale != self.scale:
+                    factor = scale / float(self.scale)
+                    _img = img.resize((int(round(img.width * factor)),
+                        int(round(img.height * factor))), Image.ANTIALIAS)
+                suffix = '' if scale == 1 else '@%sx' % scale
+                fn = os.path.join(path, '%s%s.%s' % (
+                    name, suffix, output['format']))
+                data = encode_image(_img, output)
+                with open(fn, 'wb') as f:
+                    f.write(data)
+            log.info('Saved %s (%s bytes)', fn, len(data))
+            files.append(fn)
+        return files
 
     def apply_mask(self, thumb):
-        """Make thumbnail round (that's all hip now, ain't it?), add outline."""
-        width, height = thumb.size
-        # antialias
-        bigsize = (width * 4, height * 4)
-        linewidth = 4
-        mask = Image.new('RGBA', bigsize, (255, 255, 255, 255))
-        draw = ImageDraw.Draw(mask)
-        draw.ellipse((0, 0) + bigsize, fill=(27, 29, 28, 255))
-        draw.ellipse(
-            (linewidth, linewidth) + (bigsize[0] - linewidth, bigsize[1] - linewidth),
-            fill=(255, 255, 255, 0))
-        mask = mask.resize(thumb.size, Image.ANTIALIAS)
+        """Make thumbnail round (that's all hip now, ain't it?), add outline.
+
+        The mask shape is configurable with C{mask} (C{circle}, C{roundrect}
+        or C{none}).
+        """
+        if self.mask == 'none':
+            return thumb
+        mask = get_mask(thumb.size, self.mask, self.mask_linewidth,
+            self.mask_color)
         thumb.paste(mask, (0, 0), mask)
         return thumb
 
     def is_empty_image(self, img):
+        """Check if the returned image is completely black/white.
+
+        Only a handful of colors convert to black/white, so an RGB image
+        with more colors than that can't be empty. Counting colors stops as
+        soon as there's too many, which makes this a lot faster than
+        converting to grayscale. Same results as
+        L{_is_empty_image_grayscale}.
+        """
+        if img.mode not in ['RGB', 'RGBA']:
+            return self._is_empty_image_grayscale(img)
+        black, white = get_blank_colors()
+        colors = img.getcolors(max(len(black), len(white)))
+        if colors == None:
+            if img.mode == 'RGBA':
+                # alpha is ignored in grayscale, many colors may still be
+                # the same black/white with different alpha
+                return self._is_empty_image_grayscale(img)
+            return False
+        colors = set([color[:3] for _, color in colors])
+        return colors <= black or colors <= white
+
+    def _is_empty_image_grayscale(self, img):
         """Check if the returned image is completely black/white."""
         extr = img.convert("L").getextrema()
         if extr in [(0, 0), (255, 255)]:
@@ -348,7 +1586,7 @@ class Legend(object):
         n = len(label)
         w, h = size
 
-        font = ImageFont.truetype(self.font, fontsize)
+        font = get_font(self.font, fontsize)
         draw = ImageDraw.Draw(img)
         if stack == 'horizontal':
             pad_top = (height - h) / 2
@@ -359,15 +1597,25 @@ class Legend(object):
             y += h / n
 
     def calc_label_size(self, img, label, fontsize, wraplength):
+        """Wrap label into lines, return lines and their total size.
+
+        Results are cached by font, fontsize, wraplength and label.
+        """
+        key = (self.font, fontsize, wraplength, label)
+        with _fonts_lock:
+            if key in _labels:
+                return _labels[key]
         max_word = max([len(s) for s in label.split(' ')])
         if wraplength < max_word:
             wraplength = max_word
         label = textwrap.wrap(label, wraplength)
-        font = ImageFont.truetype(self.font, fontsize)
+        font = get_font(self.font, fontsize)
         draw = ImageDraw.Draw(img)
         wh = [draw.textsize(line, font) for line in label]
         w = max([size[0] for size in wh])
         h = sum([size[1] for size in wh])
+        with _fonts_lock:
+            _labels[key] = (label, w, h)
         return label, w, h
 
     def merge_thumbnails(self, thumbs=[], add_label=False, labeltext=None,
@@ -399,7 +1647,7 @@ class Legend(object):
         if add_label == True:
             labeltext = labeltext or self.title
             label, label_width, label_height = self.calc_label_size(
-                img, labeltext, fontsize=26, wraplength=30)
+                img, labeltext, fontsize=int(26 * self.scale), wraplength=30)
             labelsize = (label_width, label_height)
             if stack == 'horizontal':
                 new_width = label_width + x + gutter
@@ -425,40 +1673,139 @@ class Legend(object):
             img = _img
         return img
 
-    def _create_thumbnail(self, stylename, geometrytype, additional_filter):
-        """Get image data and make a thumbnail for a layer for this style and
-        geometry_type.
+    def _create_thumbnails(self, stylename, additional_filter):
+        """Get image data (see L{load_image}) for thumbnails of every geometry
+        type found on the layer for this style.
+
+        With C{mosaic} enabled all thumbnails of a style are rendered with a
+        single GetMap request if possible.
         """
+        def get_extent(geometrytype):
+            try:
+                bbox, geometry_name = self._get_extent(
+                    stylename, geometrytype, additional_filter)
+            except AssertionError as ae:
+                return None
+            return (geometrytype, geometry_name, bbox)
+        extents = [
+            extent for extent in self._map(get_extent, self.get_geometry_types())
+            if extent != None
+        ]
+        if len(extents) == 0:
+            return []
+        if self.srs == None:
+            raise AttributeError(
+                "SRS (e.g 'EPSG:4326') not supplied in init conf, or undetermined from WFS request."
+            )
         size = self._size
+        transparent = self.background != None
+        images = None
+        if self.mosaic == True and len(extents) > 1:
+            images = self.server.get_mosaic(self.layername, extents, self.srs,
+                transparent=transparent, additional_filter=additional_filter,
+                style=stylename, size=size, bckground_conf=self.background,
+                max_size=self.mosaic_max_size, decode=False, dpi=self.get_dpi())
+        if images == None:
+            def create_thumbnail(extent):
+                geometrytype, geometry_name, bbox = extent
+                return self._create_thumbnail(stylename, geometrytype,
+                    geometry_name, bbox, additional_filter)
+            images = self._map(create_thumbnail, extents)
+        return images
+
+    def _map(self, fn, items):
+        """Apply C{fn} to every item, results in the same order.
+
+        Override to query for geometry types concurrently.
+        """
+        return [fn(item) for item in items]
+
+    def _get_extent(self, stylename, geometrytype, additional_filter):
+        """Get bbox and geometry name to make a thumbnail for a layer for this
+        style and geometry_type.
+        """
         if self.bbox == None:
             # will try to get bbox from WFS
-            feature = self.server.get_feature(
-                self.layername, geometrytype, self.filter)
-            assert feature != None, "No WFS %s features returned for layer '%s' using cql_filter '%s'" % (
-                geometrytype, self.layername, self.filter
-            )
-            bbox = self.get_bbox_from_feature(feature)
-            geometry_name = feature.get('geometry_name')
+            bbox, geometry_name = self.get_sample_extent(geometrytype)
         else:
             bbox = self.bbox
-        if self.srs == None:
-            raise AttributeError(
-                "SRS (e.g 'EPSG:4326') not supplied in init conf, or undetermined from WFS request."
-            )
+            geometry_name = None
+        self.bboxes.append(dict(
+            style=stylename,
+            geometrytype=geometrytype,
+            filter=additional_filter,
+            bbox=list(bbox)
+        ))
+        return bbox, geometry_name
+
+    def get_sample_extent(self, geometrytype):
+        """Get bbox and geometry name from a representative feature chosen
+        with the C{sampling} strategy, reusing the one recorded in sample
+        index if any.
+        """
+        key = json.dumps([self.server.url, self.layername, geometrytype,
+            self.filter, self.sampling, self.sample_count, self.sample_seed,
+            self.sample_random_n,
+            self.whole_feature, self.srs, self.buffer_size, self.metric_srs])
+        if self.sample_index != None:
+            data = self.sample_index.get(key)
+            if data != None:
+                sample = json.loads(data)
+                return tuple(sample['bbox']), sample['geometry_name']
+        strategy = sampling_strategies[self.sampling]
+        count = 1
+        if strategy != sample_first:
+            count = self.sample_count
+        features = self.server.get_features(
+            self.layername, geometrytype, self.filter, count,
+            geometry_only=self.geometry_only)
+        assert len(features) > 0, "No WFS %s features returned for layer '%s' using cql_filter '%s'" % (
+            geometrytype, self.layername, self.filter
+        )
+        feature = strategy(features, seed=self.sample_seed,
+            n=self.sample_random_n)
+        bbox = self.get_bbox_from_feature(feature)
+        geometry_name = feature.get('geometry_name')
+        if self.sample_index != None:
+            self.sample_index.set(key, json.dumps(dict(
+                id=feature.get('id', None),
+                bbox=list(bbox),
+                geometry_name=geometry_name
+            )))
+        return bbox, geometry_name
+
+    def get_dpi(self):
+        """GetMap resolution for C{scale}, C{None} for the default."""
+        if self.scale == 1:
+            return None
+        return int(round(90 * self.scale))
+
+    def _create_thumbnail(self, stylename, geometrytype, geometry_name, bbox,
+        additional_filter):
+        """Get image data and make a thumbnail for a layer for this style and
+        geometry_type.
+        """
+        size = self._size
         transparent = self.background != None
         return self.server.get_map(self.layername, geometrytype, geometry_name,
             bbox, self.srs,
             transparent=transparent, additional_filter=additional_filter, featureid=None,
-            style=stylename, size=size, bckground_conf=self.background)
+            style=stylename, size=size,
+            geometrytype_filtering=geometrytype != None,
+            bckground_conf=self.background, decode=False, dpi=self.get_dpi())
 
-    def get_bbox_from_feature(self, feature, buffer_size=500):
+    def get_bbox_from_feature(self, feature, buffer_size=None):
         """Some shapely magic.
 
-        NB! geometry coordinates expected to be in meters! This (i.e
-        buffer_size) should be  either configurable, or deductible from
-        layer crs.
+        Geometry coordinates are expected to be in C{srs}. C{buffer_size}
+        defaults to C{buffer_size} metres in C{srs} units, unless the bbox
+        is computed in C{metric_srs}.
         """
         assert "geometry" in feature, "This feature has no 'geometry' member"
+        if buffer_size == None:
+            if self.is_reprojected():
+                return self._get_bbox_reprojected(feature)
+            buffer_size = self.buffer_size * get_srs_scale(self.srs)
         geometry = feature["geometry"]
         geometry_type = feature["geometry"]["type"]
         shape = asShape(geometry)
@@ -494,6 +1841,130 @@ class Legend(object):
                     buffer_size)
         return pnt.buffer(buffer_size).bounds
 
+    def get_bboxes_from_features(self, features, buffer_size=None):
+        """L{get_bbox_from_feature} for many features at once.
+
+        Bboxes are the same as if computed for every feature in turn, but
+        with numpy array operations if numpy is available.
+
+        @param features: a FeatureCollection or a list of features
+        """
+        if isinstance(features, dict):
+            features = features['features']
+        if buffer_size == None and not self.is_reprojected():
+            buffer_size = self.buffer_size * get_srs_scale(self.srs)
+        if numpy == None or buffer_size == None or len(features) == 0:
+            return [self.get_bbox_from_feature(f, buffer_size)
+                for f in features]
+        geometries = [f['geometry'] for f in features]
+        # unless using whole features, polygons are checked in turn for
+        # being small, and whole features are used from the first small one
+        first_small = len(features)
+        if self.whole_feature != True:
+            rings, checked = [], []
+            for i, g in enumerate(geometries):
+                if g['type'] == 'Polygon':
+                    rings.append(g['coordinates'][0])
+                    checked.append(i)
+                elif g['type'] == 'MultiPolygon':
+                    rings.append(g['coordinates'][0][0])
+                    checked.append(i)
+            if len(rings) > 0:
+                pts, part, _ = _ragged(rings)
+                start = numpy.searchsorted(part, numpy.arange(len(rings)))
+                size = numpy.maximum.reduceat(pts, start) - \
+                    numpy.minimum.reduceat(pts, start)
+                small = numpy.nonzero(
+                    (size < buffer_size * 2).all(axis=1))[0]
+                if len(small) > 0:
+                    first_small = checked[small[0]]
+        bboxes = [None] * len(features)
+        centers, mids = [], []
+        # parts, part owners, part signs and (feature index, geometry) of
+        # whole features by dimension
+        wholes = dict([(dim, ([], [], [], [])) for dim in (0, 1, 2)])
+        def add_whole(i, geometry, dim, parts, signs=None):
+            _parts, owners, _signs, targets = wholes[dim]
+            _parts.extend(parts)
+            owners.extend([len(targets)] * len(parts))
+            _signs.extend(signs or [1] * len(parts))
+            targets.append((i, geometry))
+        def add_polygons(i, geometry, polygons):
+            rings, signs = [], []
+            for polygon in polygons:
+                rings.extend(polygon)
+                signs.extend([1] + [-1] * (len(polygon) - 1))
+            add_whole(i, geometry, 2, rings, signs)
+        for i, g in enumerate(geometries):
+            t, c = g['type'], g['coordinates']
+            whole = self.whole_feature == True or i > first_small
+            if t == 'Point':
+                centers.append((i, c))
+            elif t == 'LineString':
+                mids.append((i, c))
+            elif t == 'Polygon':
+                if whole or i == first_small:
+                    add_polygons(i, g, [c])
+                else:
+                    mids.append((i, c[0]))
+            elif t == 'MultiPoint':
+                if whole:
+                    add_whole(i, g, 0, [c])
+                else:
+                    centers.append((i, c[0]))
+            elif t == 'MultiLineString':
+                if whole:
+                    add_whole(i, g, 1, c)
+                else:
+                    mids.append((i, c[0]))
+            elif t == 'MultiPolygon':
+                if whole:
+                    add_polygons(i, g, c)
+                elif i == first_small:
+                    add_polygons(i, dict(type='Polygon', coordinates=c[0]),
+                        c[:1])
+                else:
+                    mids.append((i, c[0][0]))
+            else:
+                bboxes[i] = self.get_bbox_from_feature(features[i],
+                    buffer_size)
+        if first_small < len(features):
+            self.whole_feature = True
+        def buffered(i, x, y, r):
+            bboxes[i] = (x - r, y - r, x + r, y + r)
+        for i, c in centers:
+            buffered(i, c[0], c[1], buffer_size)
+        if len(mids) > 0:
+            for (i, _), (x, y) in zip(mids, _midpoints([l for _, l in mids])):
+                buffered(i, x, y, buffer_size)
+        for dim, (parts, owners, signs, targets) in wholes.items():
+            if len(targets) == 0:
+                continue
+            centroids, uppers, weights = _centroids(
+                parts, owners, signs, len(targets), dim)
+            radii = 1.2 * numpy.hypot(*(uppers - centroids).T)
+            for (i, g), (x, y), r, w in zip(
+                targets, centroids, radii, weights):
+                if w == 0:
+                    # degenerate geometry, let GEOS deal with it
+                    pnt, r = self._get_bbox_from_feature(asShape(g))
+                    bboxes[i] = pnt.buffer(r).bounds
+                else:
+                    buffered(i, x, y, r)
+        return [tuple(float(v) for v in bbox) for bbox in bboxes]
+
+    def is_reprojected(self):
+        """Are bboxes computed in C{metric_srs}?"""
+        return self.metric_srs != None and self.srs != None and \
+            normalize_srs(self.metric_srs) != normalize_srs(self.srs)
+
+    def _get_bbox_reprojected(self, feature):
+        shape = reproject(asShape(feature['geometry']),
+            self.srs, self.metric_srs)
+        bbox = self.get_bbox_from_feature(
+            dict(feature, geometry=mapping(shape)), self.buffer_size)
+        return reproject_bounds(bbox, self.metric_srs, self.srs)
+
     def _get_bbox_from_feature(self, shape):
         pnt = shape.centroid
         _, _, xmax, ymax = shape.bounds
@@ -501,46 +1972,610 @@ class Legend(object):
         buffer_size *= 1.2
         return pnt, buffer_size
 
-def run(conf_file_path):
+def _process_thumbnails(legend, images, add_label):
+    """L{Legend.process_thumbnails} for use in a multiprocessing.Pool.
+
+    Returns raw image data, empty GetMap responses learned and stage timing
+    records (see L{record}).
+    """
+    learned = []
+    report = Report()
+    previous = set_report(report)
+    set_layer(legend.layername)
+    try:
+        img = legend.process_thumbnails(images, add_label, learned)
+    finally:
+        set_report(previous)
+    if img == None:
+        return None, learned, report.records
+    return dump_image(img), learned, report.records
+
+def pack(sizes, max_size=2048, padding=2):
+    """Pack rectangles of C{sizes} into as few sheets of at most C{max_size}
+    by C{max_size} pixels as possible. Skyline bottom-left heuristic,
+    tallest rectangles first. Sheets of rectangles larger than C{max_size}
+    are made larger.
+
+    @return: C{(sheet, x, y)} of every rectangle (in the order of C{sizes})
+        and C{(width, height)} of every sheet
+    """
+    order = sorted(range(len(sizes)),
+        key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    positions = [None] * len(sizes)
+    sheets = []
+    for i in order:
+        w, h = sizes[i][0] + padding, sizes[i][1] + padding
+        for n, sheet in enumerate(sheets):
+            fit = _skyline_fit(sheet, w, h)
+            if fit != None:
+                break
+        else:
+            n = len(sheets)
+            sheet = dict(skyline=[(0, 0, max(max_size, w))],
+                height=max(max_size, h), size=(0, 0))
+            sheets.append(sheet)
+            fit = _skyline_fit(sheet, w, h)
+        x, y = fit
+        _skyline_add(sheet, x, y, w, h)
+        sheet['size'] = (max(sheet['size'][0], x + sizes[i][0]),
+            max(sheet['size'][1], y + sizes[i][1]))
+        positions[i] = (n, x, y)
+    return positions, [sheet['size'] for sheet in sheets]
+
+def _skyline_fit(sheet, w, h):
+    """Lowest (then leftmost) position a C{w} by C{h} rectangle fits in."""
+    skyline = sheet['skyline']
+    best = None
+    for j, (x, _, _) in enumerate(skyline):
+        y, remaining, k = 0, w, j
+        while remaining > 0 and k < len(skyline):
+            y = max(y, skyline[k][1])
+            remaining -= skyline[k][2]
+            k += 1
+        if remaining > 0 or y + h > sheet['height']:
+            continue
+        if best == None or (y, x) < (best[1], best[0]):
+            best = (x, y)
+    return best
+
+def _skyline_add(sheet, x, y, w, h):
+    skyline = [(x, y + h, w)]
+    for sx, sy, sw in sheet['skyline']:
+        if sx + sw <= x or sx >= x + w:
+            skyline.append((sx, sy, sw))
+            continue
+        if sx < x:
+            skyline.append((sx, sy, x - sx))
+        if sx + sw > x + w:
+            skyline.append((x + w, sy, sx + sw - x - w))
+    skyline.sort()
+    merged = [skyline[0]]
+    for sx, sy, sw in skyline[1:]:
+        px, py, pw = merged[-1]
+        if py == sy:
+            merged[-1] = (px, py, pw + sw)
+        else:
+            merged.append((sx, sy, sw))
+    sheet['skyline'] = merged
+
+def write_sprites(legends, path, max_size=2048, padding=2):
+    """Pack legend images into sprite sheets (C{path}-0.png, C{path}-1.png,
+    ...) and write an index of them to C{path}.json.
+
+    The index lists sheet filenames and every legend's sheet, offset, size
+    and title by the legend's filename without extension, or by its path
+    relative to the common directory of legends if the filename is not
+    unique (e.g the same layer on several servers).
+
+    @param legends: list of C{(filename, title)}
+    @return: list of paths of written files
+    """
+    # the same file is packed once
+    unique = OrderedDict()
+    for filename, title in legends:
+        unique.setdefault(filename, title)
+    legends = unique.items()
+    keys = [os.path.splitext(os.path.basename(f))[0] for f, _ in legends]
+    if len(set(keys)) < len(keys):
+        directories = [os.path.dirname(os.path.realpath(f)) + os.sep
+            for f, _ in legends]
+        common = os.path.commonprefix(directories)
+        common = common[:common.rfind(os.sep) + 1]
+        keys = [key if keys.count(key) == 1 else os.path.splitext(
+            os.path.relpath(os.path.realpath(f), common))[0]
+            for key, (f, _) in zip(keys, legends)]
+    # files are only kept open while reading, there may be thousands
+    image_sizes = []
+    for filename, _ in legends:
+        with Image.open(filename) as img:
+            image_sizes.append(img.size)
+    positions, sizes = pack(image_sizes, max_size, padding)
+    directory, name = os.path.split(path)
+    sheets = ['%s-%s.png' % (name, n) for n in range(len(sizes))]
+    index = dict(sheets=sheets, legends={})
+    files = []
+    for n, size in enumerate(sizes):
+        sheet = Image.new('RGBA', size, (255, 255, 255, 0))
+        for (filename, title), (_n, x, y) in zip(legends, positions):
+            if _n == n:
+                with Image.open(filename) as img:
+                    sheet.paste(img, (x, y))
+        sheet.save(os.path.join(directory, sheets[n]), 'PNG')
+        files.append(os.path.join(directory, sheets[n]))
+    for key, (filename, title), (width, height), (n, x, y) in zip(
+        keys, legends, image_sizes, positions):
+        index['legends'][key] = dict(sheet=n, x=x, y=y,
+            width=width, height=height, title=title)
+    with open('%s.json' % path, 'w') as f:
+        f.write(json.dumps(index, indent=1, sort_keys=True))
+    files.append('%s.json' % path)
+    return files
+
+def write_run_sprites(conf, jobs, files, sprites=None):
+    """Write sprite sheets (see L{write_sprites}) of legends of every server
+    with a C{sprites} configuration, and of all legends to C{sprites} path
+    if given.
+
+    @param files: saved files of every job
+    """
+    legends = OrderedDict()
+    for job, _files in zip(jobs, files):
+        title = job['layerconf'].get('title', None) or job['layername']
+        # only the 1x scale of legends
+        legends.setdefault(job['server'], []).extend([
+            (f, title) for f in _files
+            if re.search(r'@[0-9.]+x$', os.path.splitext(f)[0]) == None
+        ])
+    written = []
+    for server, _legends in legends.items():
+        spriteconf = conf.get(server, {}).get('sprites', None)
+        if spriteconf != None and len(_legends) > 0:
+            out_path = os.path.realpath(conf[server].get('out_path', '.'))
+            written.extend(write_sprites(_legends,
+                os.path.join(out_path, spriteconf.get('name', 'sprites')),
+                spriteconf.get('max_size', 2048),
+                spriteconf.get('padding', 2)))
+    _legends = sum(legends.values(), [])
+    if sprites != None and len(_legends) > 0:
+        written.extend(write_sprites(_legends, sprites))
+    return written
+
+
+class Manifest(object):
+    """Records the inputs of every output of a run, so legends with
+    unchanged inputs can be skipped next time.
+
+    Kept as a JSON file in the output directory.
+    """
+    filename = '.legender-manifest.json'
+
+    def __init__(self, path):
+        self.path = os.path.join(path, self.filename)
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.loads(f.read())
+        else:
+            self.entries = {}
+
+    def is_current(self, key, signature):
+        """Is the output of C{key} built from inputs with C{signature}?
+
+        Never with an undetermined (C{None}) signature.
+        """
+        if signature == None:
+            return False
+        entry = self.entries.get(key, None)
+        if entry == None or entry['signature'] != signature:
+            return False
+        return all([os.path.exists(f) for f in entry['files']])
+
+    def get_files(self, key):
+        """Files of C{key} saved in an earlier run."""
+        return self.entries.get(key, {}).get('files', [])
+
+    def update(self, key, entry):
+        with self._lock:
+            self.entries[key] = entry
+            tmp = '%s.tmp' % self.path
+            with open(tmp, 'w') as f:
+                f.write(json.dumps(self.entries, indent=1, sort_keys=True))
+            os.rename(tmp, self.path)
+
+job_defaults = dict(
+    out_path='.',
+    background=None,
+    username=None,
+    password=None,
+    add_labels=True,
+    width=None,
+    height=None,
+    preflight_cache=None,
+    transport=None,
+    http_cache=None,
+    capabilities_cache=None,
+    font=None,
+    sample_index=None,
+    output=None
+)
+
+def build_jobs(conf):
+    """Flatten the nested server/layer configuration into a list of jobs.
+
+    Each job is a plain C{dict} describing everything needed to produce the
+    legend file(s) of a single layer, see L{run_job}. Only C{server},
+    C{layername} and C{layerconf} are required, see C{job_defaults} for the
+    rest.
+
+    Layers of workspaces listed in a server's C{discover} configuration are
+    added from WMS capabilities, see L{discover_layers}.
+    """
+    jobs = []
+    for server, serverconf in conf.items():
+        layers = serverconf.get('layers', [])
+        out_path = os.path.realpath(serverconf.get('out_path', '.'))
+        assert os.path.exists(out_path), "out_path %s does not exist" % (
+            out_path, )
+        if serverconf.get('discover', None) != None:
+            layers = layers + discover_layers(server, serverconf)
+        settings = server_settings(serverconf)
+        for layer in layers:
+            for layername, c in layer.items():
+                job = dict(
+                    server=server,
+                    layername=layername,
+                    layerconf=c,
+                    out_path=out_path
+                )
+                job.update(settings)
+                jobs.append(job)
+    return jobs
+
+def server_settings(serverconf):
+    """Job settings (see C{job_defaults}) from a server's configuration."""
+    return dict(
+        background=serverconf.get('background', None),
+        username=serverconf.get('auth', {}).get('username', None),
+        password=serverconf.get('auth', {}).get('password', None),
+        add_labels=serverconf.get('add_labels', True),
+        width=serverconf.get('size', {}).get('width', None),
+        height=serverconf.get('size', {}).get('height', None),
+        preflight_cache=serverconf.get('preflight_cache', None),
+        transport=serverconf.get('transport', None),
+        http_cache=serverconf.get('http_cache', None),
+        capabilities_cache=serverconf.get('capabilities_cache', None),
+        font=serverconf.get('font', None),
+        sample_index=serverconf.get('sample_index', None),
+        output=serverconf.get('output', None)
+    )
+
+def discover_layers(server, serverconf):
+    """Build layer configurations from WMS capabilities.
+
+    Server's C{discover} configuration lists C{workspaces} to discover
+    (C{null} for all layers of the server), whether to use C{all_styles}
+    and C{filters} to use for every layer (srs defaults to the layer's
+    native srs). Layers already configured are skipped.
+    """
+    discover = serverconf['discover']
+    known = set()
+    for layer in serverconf.get('layers', []):
+        known.update(layer.keys())
+    gs = GeoServer(server,
+        username=serverconf.get('auth', {}).get('username', None),
+        password=serverconf.get('auth', {}).get('password', None),
+        transport=serverconf.get('transport', None),
+        capabilities_cache=serverconf.get('capabilities_cache', None))
+    layers = []
+    for workspace in discover.get('workspaces', None) or [None]:
+        capabilities = gs.get_capabilities(workspace)
+        for layername in sorted(capabilities.keys()):
+            if layername in known:
+                continue
+            info = capabilities[layername]
+            filters = []
+            for filterconf in discover.get('filters', None) or [{}]:
+                filterconf = filterconf.copy()
+                if not 'srs' in filterconf:
+                    filterconf['srs'] = info['srs']
+                if not 'title' in filterconf and info['title'] != None:
+                    filterconf['title'] = info['title']
+                if discover.get('all_styles', False) == True:
+                    filterconf['styles'] = 'all'
+                filters.append(filterconf)
+            layers.append({layername: dict(filters=filters)})
+    return layers
+
+def job_signature(job, fingerprints):
+    """Hash of a job's configuration and style SLD fingerprints.
+
+    Returns C{None} if any of the SLD fingerprints is unknown.
+    """
+    if None in fingerprints.values():
+        return None
+    data = json.dumps(dict(job=job, styles=fingerprints), sort_keys=True)
+    return hashlib.sha1(data).hexdigest()
+
+def job_key(job):
+    """Key of a job's entry in a L{Manifest}."""
+    return '%s|%s' % (job['server'], job['layername'])
+
+def get_legend(job, cls=GeoServer, legend_cls=Legend, pool=None):
+    """Return a L{Legend} set up with server settings of a job."""
+    return legend_cls(
+        cls, job['server'], pool=pool,
+        username=job['username'], password=job['password'],
+        preflight_cache=job['preflight_cache'],
+        transport=job['transport'],
+        http_cache=job['http_cache'],
+        capabilities_cache=job['capabilities_cache'],
+        sample_index=job['sample_index'])
+
+def create_job_thumbnails(legend, job):
+    """Create thumbnails of every filter of a job's layer."""
+    background = job['background']
+    width, height = job['width'], job['height']
+    output = job['output']
+    for filterconf in job['layerconf'].get('filters', []):
+        filterconf = filterconf.copy()
+        if background != None and background.get('use', True) == True:
+            filterconf['background'] = background.copy()
+        if width != None and height != None and \
+            not 'size' in filterconf:
+            filterconf['size'] = (width, height)
+        if job['font'] != None and not 'font' in filterconf:
+            filterconf['font'] = job['font']
+        if output != None and not 'scale' in filterconf:
+            # render at the largest scale, others are resampled from it
+            filterconf['scale'] = max(output.get('scales', [1]))
+        legend.update_conf(job['layername'], filterconf)
+        legend.create_thumbnails(job['add_labels'])
+
+def run_job(job, manifest=None, cls=GeoServer, legend_cls=Legend, pool=None):
+    """Create and save legend image(s) for a single layer job.
+
+    If a L{Manifest} is given, the job is skipped when its configuration
+    and styles have not changed since the last run. Image processing is
+    done in C{pool} (a C{multiprocessing.Pool}) if given.
+
+    @return: list of saved files, C{None} if the job was skipped
+    """
+    layername = job['layername']
+    set_layer(layername)
+    c = job['layerconf']
+    filters = c.get('filters', [])
+    title = c.get('title', None)
+    group = c.get('group', False)
+    filename = '%s.png' % (c.get('filename', layername), )
+    l = get_legend(job, cls, legend_cls, pool)
+    if manifest != None:
+        key = job_key(job)
+        styles = set()
+        for filterconf in filters:
+            _styles = filterconf.get('styles', ['default'])
+            if _styles == 'all':
+                _styles = l.server.get_styles(layername)
+            styles.update(_styles)
+        fingerprints = dict([
+            (style, l.server.get_style_fingerprint(layername, style))
+            for style in styles
+        ])
+        signature = job_signature(job, fingerprints)
+        if manifest.is_current(key, signature):
+            log.info('Skipping unchanged %s', layername)
+            return None
+    # thumbnails are written as soon as they're ready
+    l.stream_to(job['out_path'], filename.lower(), title, group,
+        job['output'])
+    create_job_thumbnails(l, job)
+    files = l.save()
+    if manifest != None:
+        manifest.update(key, dict(
+            signature=signature,
+            conf=c,
+            styles=fingerprints,
+            bboxes=l.bboxes,
+            files=files
+        ))
+    return files
+
+def load_conf(conf_file_path):
+    """Load configuration, paths in it are relative to the config file."""
     p, f = os.path.split(conf_file_path)
     if os.path.exists(p):
         os.chdir(p)
     with open(f) as _c:
-        conf = json.loads(_c.read())
-        for server, serverconf in conf.items():
-            layers = serverconf.get('layers', [])
-            background = serverconf.get('background', None)
-            out_path = os.path.realpath(serverconf.get('out_path', '.'))
-            username = serverconf.get('auth', {}).get('username', None)
-            password = serverconf.get('auth', {}).get('password', None)
-            add_labels = serverconf.get('add_labels', True)
-            width = serverconf.get('size', {}).get('width', None)
-            height = serverconf.get('size', {}).get('height', None)
-            assert os.path.exists(out_path), "out_path %s does not exist" % (
-                out_path, )
-            for layer in layers:
-                for layername, c in layer.items():
-                    filters = c.get('filters', [])
-                    title = c.get('title', None)
-                    group = c.get('group', False)
-                    filename = '%s.png' % (c.get('filename', layername), )
-                    l = Legend(
-                        GeoServer, server,
-                        username=username, password=password)
-                    for filterconf in filters:
-                        if background.get('use', True) == True:
-                            filterconf['background'] = background.copy()
-                        if width != None and height != None and \
-                            not 'size' in filterconf:
-                            filterconf['size'] = (width, height)
-                        l.update_conf(layername, filterconf)
-                        l.create_thumbnails(add_labels)
-                    l.save(out_path, filename.lower(), title, group)
+        return json.loads(_c.read())
+
+def get_manifests(jobs):
+    """Return a L{Manifest} for every output path used by C{jobs}."""
+    manifests = {}
+    for job in jobs:
+        if job['out_path'] not in manifests:
+            manifests[job['out_path']] = Manifest(job['out_path'])
+    return manifests
+
+def run(conf_file_path, workers=1, incremental=False, processes=1,
+    sprites=None):
+    """Run legend generation for a configuration file.
+
+    @param workers: number of layers processed concurrently. Every server
+        may further limit the number of its concurrently processed layers
+        with a C{workers} key in its configuration.
+    @type workers: C{int}
+    @param incremental: only rebuild legends whose configuration or styles
+        have changed since the last run (see L{Manifest}).
+    @type incremental: C{bool}
+    @param processes: number of processes for image processing, with 1
+        images are processed where they're fetched.
+    @type processes: C{int}
+    @param sprites: path to write sprite sheets of all legends to, see
+        L{write_run_sprites}
+    """
+    conf = load_conf(conf_file_path)
+    jobs = build_jobs(conf)
+    manifests = {}
+    if incremental == True:
+        manifests = get_manifests(jobs)
+    process_pool = None
+    if processes > 1:
+        process_pool = multiprocessing.Pool(processes)
+    def _run_job(job):
+        manifest = manifests.get(job['out_path'], None)
+        files = run_job(job, manifest, pool=process_pool)
+        if files == None:
+            # skipped, files are from an earlier run
+            files = manifest.get_files(job_key(job))
+        return files
+    try:
+        if workers <= 1:
+            files = [_run_job(job) for job in jobs]
+        else:
+            limits = {}
+            for server, serverconf in conf.items():
+                limits[server] = threading.BoundedSemaphore(
+                    serverconf.get('workers', workers))
+            def _run_limited(job):
+                with limits[job['server']]:
+                    return _run_job(job)
+            pool = ThreadPool(workers)
+            try:
+                files = pool.map(_run_limited, jobs)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        if process_pool != None:
+            process_pool.close()
+            process_pool.join()
+    write_run_sprites(conf, jobs, files, sprites)
+
+
+def run_stream(jobs_file, results_file, workers=1, incremental=False,
+    processes=1):
+    """Run jobs read from a JSON lines file, one job (see L{build_jobs}) per
+    line, as they arrive.
+
+    At most C{workers} jobs are read ahead, so memory use doesn't depend on
+    the number of jobs. A JSON result line with status (C{ok}, C{skipped}
+    or C{error}), time taken and saved files is written to C{results_file}
+    for every job.
+
+    @param jobs_file: file like object to read jobs from (e.g stdin)
+    @param results_file: file like object to write results to
+    """
+    manifests = {}
+    lock = threading.Lock()
+    process_pool = None
+    if processes > 1:
+        process_pool = multiprocessing.Pool(processes)
+    def write_result(result):
+        with lock:
+            results_file.write(json.dumps(result) + '\n')
+            results_file.flush()
+    def _run_job(n, job):
+        result = dict(line=n, server=job.get('server', None),
+            layername=job.get('layername', None))
+        start = time.time()
+        try:
+            manifest = None
+            if incremental == True:
+                with lock:
+                    if job['out_path'] not in manifests:
+                        manifests[job['out_path']] = Manifest(job['out_path'])
+                    manifest = manifests[job['out_path']]
+            files = run_job(job, manifest, pool=process_pool)
+        except Exception as e:
+            result.update(status='error', error='%s: %s' % (
+                e.__class__.__name__, e))
+        else:
+            result.update(status='skipped' if files == None else 'ok',
+                files=files or [],
+                sizes=[os.path.getsize(f) for f in files or []])
+        result['seconds'] = round(time.time() - start, 3)
+        write_result(result)
+    def _run_pooled(n, job):
+        try:
+            _run_job(n, job)
+        except Exception:
+            # e.g writing the result failed
+            log.exception('Job on line %s failed', n)
+        finally:
+            slots.release()
+    pool = None
+    if workers > 1:
+        pool = ThreadPool(workers)
+        slots = threading.BoundedSemaphore(workers)
+    try:
+        # readline instead of iterating, so lines are handled as they arrive
+        for n, line in enumerate(iter(jobs_file.readline, ''), 1):
+            if line.strip() == '':
+                continue
+            try:
+                job = dict(job_defaults, **json.loads(line))
+                job['out_path'] = os.path.realpath(job['out_path'])
+            except (TypeError, ValueError) as e:
+                write_result(dict(line=n, status='error', error='%s: %s' % (
+                    e.__class__.__name__, e), seconds=0))
+                continue
+            if pool == None:
+                _run_job(n, job)
+            else:
+                slots.acquire()
+                pool.apply_async(_run_pooled, (n, job))
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+        if process_pool != None:
+            process_pool.close()
+            process_pool.join()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate map legend thumbnails.')
     parser.add_argument('-c', type=str, help="Path to the configuration file")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+        help="Number of layers to process concurrently")
+    parser.add_argument('-i', '--incremental', action='store_true',
+        help="Only rebuild legends with changed configuration or styles")
+    parser.add_argument('-p', '--processes', type=int, default=1,
+        help="Number of processes for image processing")
+    parser.add_argument('-j', '--jobs', type=str,
+        help="Run jobs from a JSON lines file instead (- for stdin)")
+    parser.add_argument('-o', '--results', type=str, default='-',
+        help="Where to write job results to with --jobs (- for stdout)")
+    parser.add_argument('-s', '--sprites', type=str,
+        help="Also pack all legends into sprite sheets at this path")
+    parser.add_argument('--dump-jobs', action='store_true',
+        help="Write jobs of the configuration file as JSON lines to stdout")
+    parser.add_argument('--report', type=str,
+        help="Write request and image processing timings to this JSON or "
+            "CSV file")
+    parser.add_argument('--log-level', type=str, default='INFO',
+        help="Logging level (DEBUG, INFO, WARNING or ERROR)")
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(),
+        format='%(asctime)s %(levelname)s %(message)s')
     conf_file_path = args.c
-    run(conf_file_path)
+    report = args.report
+    if report != None:
+        # paths in configuration are relative to it, not this one
+        report = os.path.realpath(report)
+    if args.dump_jobs:
+        for job in build_jobs(load_conf(conf_file_path)):
+            sys.stdout.write(json.dumps(job) + '\n')
+    elif args.jobs != None:
+        jobs_file = sys.stdin if args.jobs == '-' else open(args.jobs)
+        results_file = sys.stdout if args.results == '-' else open(args.results, 'a')
+        with reporting(report):
+            run_stream(jobs_file, results_file,
+                args.workers, args.incremental, args.processes)
+    else:
+        sprites = args.sprites
+        if sprites != None:
+            # paths in configuration are relative to it, not this one
+            sprites = os.path.realpath(sprites)
+        with reporting(report):
+            run(conf_file_path, args.workers, args.incremental,
+                args.processes, sprites)
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""HTTP service rendering legends on demand.
+
+Legends are requested with C{/legend?layer=...&style=...&filter=...} and
+served from a memory (and optionally disk) cache. Concurrent requests for
+the same legend are rendered once. Cache statistics are served at
+C{/metrics}.
+"""
+import argparse, json, logging, os, threading, time, urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from legender import GeoServer, Legend, LRUCache, create_job_thumbnails, \
+    encode_image, get_legend, job_defaults, load_conf, log, output_defaults, \
+    server_settings, set_layer
+
+
+class LegendService(object):
+    """Render legends of servers in configuration C{conf} (as for
+    L{legender.run}, C{layers} aren't needed) on demand.
+    """
+    def __init__(self, conf, cache_size=256, cache_path=None, cache_ttl=None,
+        cls=GeoServer, legend_cls=Legend):
+        self.conf = conf
+        self.cls = cls
+        self.legend_cls = legend_cls
+        self.cache = LRUCache(cache_size, cache_path, cache_ttl)
+        # renders in progress by cache key
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.metrics = dict(requests=0, hits=0, misses=0, coalesced=0,
+            errors=0, render_seconds=0.0)
+
+    def get_metrics(self):
+        """Return request counts and cache hit rate.
+
+        Requests waiting for a render already in progress are C{coalesced},
+        they count as hits too.
+        """
+        with self._lock:
+            metrics = self.metrics.copy()
+        requests = metrics['requests']
+        metrics['hit_rate'] = None
+        if requests > 0:
+            metrics['hit_rate'] = round(
+                (metrics['hits'] + metrics['coalesced']) / float(requests), 4)
+        metrics['cached'] = len(self.cache)
+        return metrics
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.metrics[name] += n
+
+    def get_job(self, params):
+        """Build a job (see L{legender.build_jobs}) from request parameters.
+
+        C{layer} is required, C{server} too if there's more than one server
+        configured. Optional C{style}, C{filter}, C{srs}, C{bbox}, C{title},
+        C{width}, C{height} and C{scale} are as in the configuration file.
+        """
+        server = params.get('server', None)
+        if server == None:
+            if len(self.conf) != 1:
+                raise ValueError('server is required')
+            server = self.conf.keys()[0]
+        if server not in self.conf:
+            raise ValueError('Unknown server %s' % server)
+        layername = params.get('layer', None)
+        if layername == None:
+            raise ValueError('layer is required')
+        filterconf = dict(styles=[params.get('style', 'default')])
+        for key in ('filter', 'srs', 'title'):
+            if key in params:
+                filterconf[key] = params[key]
+        try:
+            if 'bbox' in params:
+                filterconf['bbox'] = [
+                    float(v) for v in params['bbox'].split(',')]
+                assert len(filterconf['bbox']) == 4
+            if 'width' in params and 'height' in params:
+                filterconf['size'] = (
+                    int(params['width']), int(params['height']))
+            # a single scale is served, whatever output scales are
+            filterconf['scale'] = float(params.get('scale', 1))
+        except (AssertionError, ValueError):
+            raise ValueError('Invalid bbox, width, height or scale')
+        job = dict(job_defaults, **server_settings(self.conf[server]))
+        job.update(server=server, layername=layername,
+            layerconf=dict(filters=[filterconf]))
+        return job
+
+    def get_legend(self, job):
+        """Return encoded legend image of a job (empty if there's nothing to
+        show), from cache or rendered once for concurrent requests.
+        """
+        key = json.dumps(job, sort_keys=True)
+        self._count('requests')
+        data = self.cache.get(key)
+        if data != None:
+            self._count('hits')
+            return data
+        with self._lock:
+            pending = self._pending.get(key, None)
+            leader = pending == None
+            if leader:
+                # rendered and cached since the check above
+                data = self.cache.get(key)
+                if data != None:
+                    self.metrics['hits'] += 1
+                    return data
+                pending = self._pending[key] = dict(done=threading.Event())
+        if leader == False:
+            self._count('coalesced')
+            pending['done'].wait()
+            if 'error' in pending:
+                raise pending['error']
+            return pending['data']
+        self._count('misses')
+        start = time.time()
+        try:
+            data = self.render(job)
+            self.cache.set(key, data)
+            pending['data'] = data
+        except Exception as e:
+            self._count('errors')
+            pending['error'] = e
+            raise
+        finally:
+            self._count('render_seconds', time.time() - start)
+            with self._lock:
+                del self._pending[key]
+            pending['done'].set()
+        return data
+
+    def render(self, job):
+        """Render and encode the legend image of a job, empty if there's
+        nothing to show.
+        """
+        set_layer(job['layername'])
+        l = get_legend(job, self.cls, self.legend_cls)
+        filterconf = job['layerconf']['filters'][0]
+        if filterconf.get('srs', None) == None:
+            # native srs of the layer
+            workspace, _ = l.server.split_layername(job['layername'])
+            info = l.server.get_capabilities(workspace).get(
+                job['layername'], {})
+            job = dict(job, layerconf=dict(filters=[
+                dict(filterconf, srs=info.get('srs', None))]))
+        create_job_thumbnails(l, job)
+        if len(l._thumbs) == 0:
+            return ''
+        if len(l._thumbs) == 1:
+            img = l._thumbs.pop().values()[0]
+        else:
+            img = l.merge_group()
+        return encode_image(img, job['output'])
+
+    def content_type(self, job):
+        output = dict(output_defaults, **(job['output'] or {}))
+        return 'image/%s' % output['format']
+
+
+class LegendHandler(BaseHTTPRequestHandler):
+    """Serves C{/legend} and C{/metrics} of C{server.service}."""
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        service = self.server.service
+        if url.path == '/metrics':
+            return self.respond(200, 'application/json',
+                json.dumps(service.get_metrics()))
+        if url.path != '/legend':
+            return self.respond(404, 'text/plain', 'Not found')
+        params = dict(urlparse.parse_qsl(url.query))
+        try:
+            job = service.get_job(params)
+        except ValueError as e:
+            return self.respond(400, 'text/plain', str(e))
+        try:
+            data = service.get_legend(job)
+        except Exception as e:
+            return self.respond(502, 'text/plain', '%s: %s' % (
+                e.__class__.__name__, e))
+        if data == '':
+            return self.respond(404, 'text/plain', 'Nothing to show')
+        self.respond(200, service.content_type(job), data)
+
+    def respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.info('%s %s', self.client_address[0], format % args)
+
+
+class LegendServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, LegendHandler)
+        self.service = service
+
+
+def serve(conf_file_path, host='localhost', port=8080, cache_size=256,
+    cache_path=None, cache_ttl=None):
+    """Serve legends of servers in a configuration file until interrupted.
+
+    @param cache_path: directory to keep rendered legends in, in addition
+        to C{cache_size} most recently used ones in memory
+    @param cache_ttl: seconds rendered legends are kept
+    """
+    service = LegendService(load_conf(conf_file_path),
+        cache_size, cache_path, cache_ttl)
+    server = LegendServer((host, port), service)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve map legend thumbnails over HTTP.')
+    parser.add_argument('-c', type=str, help="Path to the configuration file")
+    parser.add_argument('--host', type=str, default='localhost',
+        help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8080,
+        help="Port to listen on")
+    parser.add_argument('--cache-size', type=int, default=256,
+        help="Number of legends cached in memory")
+    parser.add_argument('--cache-path', type=str,
+        help="Directory to cache legends in")
+    parser.add_argument('--cache-ttl', type=int,
+        help="Seconds legends are cached")
+    parser.add_argument('--log-level', type=str, default='INFO',
+        help="Logging level (DEBUG, INFO, WARNING or ERROR)")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(),
+        format='%(asctime)s %(levelname)s %(message)s')
+    cache_path = args.cache_path
+    if cache_path != None:
+        # paths in configuration are relative to it, not this one
+        cache_path = os.path.realpath(cache_path)
+    serve(args.c, args.host, args.port, args.cache_size, cache_path,
+        args.cache_ttl)
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
-import requests
+import json, os, pickle, requests, shutil, tempfile, threading, time
+from PIL import Image
 from PIL.PngImagePlugin import PngImageFile
+from StringIO import StringIO
 
 from nose import tools
 
-from legender import GeoServer, Legend
+from legender import GeoServer, Legend, LRUCache, Manifest, build_jobs, \
+    dump_image, empty_map_key, encode_image, get_mask, is_empty_map, \
+    job_signature, pack, reporting, run_stream, set_layer, timed, \
+    write_sprites
+from service import LegendServer, LegendService
 
 GS_URL = 'https://gsavalik.envir.ee/geoserver'
 
@@ -48,6 +54,113 @@ def test_service_url_no_workspace():
     print 'Test service url with NO workspace'
     tools.assert_equals(gs.service_url(inputs), expect)
 
+def test_session_shared():
+    print 'Test HTTP session is shared between GeoServer instances'
+    gs1 = GeoServer(GS_URL)
+    gs2 = GeoServer(GS_URL + '/')
+    tools.assert_is(gs1.session, gs2.session)
+    gs3 = GeoServer(GS_URL, username='black', password='magic')
+    tools.assert_is_not(gs1.session, gs3.session)
+    tools.assert_equals(gs3.session.auth, ('black', 'magic'))
+
+def test_lru_cache_eviction():
+    print 'Test LRU cache evicts least recently used entries'
+    cache = LRUCache(size=2)
+    cache.set('a', 'A')
+    cache.set('b', 'B')
+    tools.assert_equals(cache.get('a'), 'A')
+    cache.set('c', 'C')
+    tools.assert_is_none(cache.get('b'))
+    tools.assert_equals(cache.get('a'), 'A')
+    tools.assert_equals(cache.get('c'), 'C')
+
+def test_lru_cache_ttl():
+    cache = LRUCache(size=2, ttl=60)
+    print 'Test LRU cache entries expire in memory'
+    cache.set('a', 'A')
+    tools.assert_equals(cache.get('a'), 'A')
+    cache._set('a', 'A', time.time() - 61)
+    tools.assert_is_none(cache.get('a'))
+    tools.assert_equals(len(cache), 0)
+
+def test_lru_cache_disk():
+    path = tempfile.mkdtemp()
+    print 'Test LRU cache falls back to disk'
+    LRUCache(size=1, path=path).set('a', 'A')
+    tools.assert_equals(LRUCache(size=1, path=path).get('a'), 'A')
+    shutil.rmtree(path)
+
+def test_conditional_get_not_modified():
+    path = tempfile.mkdtemp()
+    gs = GeoServer(GS_URL, http_cache={"path": path})
+    requested = []
+    class Session(object):
+        def get(self, url, params=None, headers=None):
+            requested.append(headers)
+            r = requests.Response()
+            r.url = url
+            if 'If-None-Match' in headers:
+                r.status_code = 304
+                r._content = ''
+            else:
+                r.status_code = 200
+                r.headers['ETag'] = '"42"'
+                r._content = 'magic'
+            return r
+    gs.session = Session()
+    print 'Test cached response is reused on 304 Not Modified'
+    for i in range(2):
+        tools.assert_equals(
+            gs._do_query('content', gs.service_url(None), a=1), 'magic')
+    tools.assert_equals(requested, [{}, {'If-None-Match': '"42"'}])
+    shutil.rmtree(path)
+
+def test_report():
+    gs = GeoServer(GS_URL)
+    class Session(object):
+        def get(self, url, params=None):
+            r = requests.Response()
+            r.url = url
+            r.status_code = 200
+            r._content = 'magic'
+            return r
+    gs.session = Session()
+    path = tempfile.mkdtemp()
+    print 'Test requests and stages are recorded while reporting'
+    with reporting(os.path.join(path, 'report.json')) as report:
+        set_layer(GS_LYRNAME)
+        gs._do_query('content', gs.service_url(None), request='GetMap',
+            layers=GS_LYRNAME, style='a')
+        with timed('mask'):
+            pass
+        gs._get(GS_URL, session=Session(), request='background',
+            params=dict(request='GetMap', layers='orthophoto'))
+    set_layer(None)
+    request, stage, background = report.records
+    tools.assert_equals((background['request'], background['layer']),
+        ('background', GS_LYRNAME))
+    tools.assert_equals((request['kind'], request['request'],
+        request['layer'], request['style'], request['status'],
+        request['bytes']), ('request', 'GetMap', GS_LYRNAME, 'a', 200, 5))
+    tools.assert_equals((stage['kind'], stage['stage'], stage['layer']),
+        ('stage', 'mask', GS_LYRNAME))
+    with open(os.path.join(path, 'report.json')) as f:
+        summary = json.load(f)['summary']
+    tools.assert_equals(summary['requests']['GetMap']['count'], 1)
+    tools.assert_equals(summary['servers'][GS_URL]['bytes'], 10)
+    tools.assert_equals(summary['layers'][GS_LYRNAME]['count'], 3)
+    tools.assert_equals(summary['styles'].keys(), ['%s|a' % GS_LYRNAME])
+    tools.assert_equals(summary['stages']['mask']['count'], 1)
+    tools.assert_equals(len(summary['slowest_requests']), 2)
+    print 'Test report is written as CSV'
+    report.write(os.path.join(path, 'report.csv'))
+    with open(os.path.join(path, 'report.csv')) as f:
+        tools.assert_equals(len(f.read().splitlines()), 4)
+    print 'Test nothing is recorded without reporting'
+    gs._do_query('content', gs.service_url(None), request='GetMap')
+    tools.assert_equals(len(report.records), 3)
+    shutil.rmtree(path)
+
 ###
 # WFS preflight checks
 ###
@@ -76,6 +189,133 @@ def test_wfs_get_feature_preflight_no_wfs():
     tools.assert_in('wfs_available', data)
     tools.assert_false(data['wfs_available'])
 
+def test_preflight_checks_cached():
+    gs = GeoServer(GS_URL)
+    calls = []
+    def do_preflight_wfs(workspace, layername):
+        calls.append(layername)
+        return dict(wfs_available=True, features_present=True,
+            geometry_name='shape')
+    gs.do_preflight_wfs = do_preflight_wfs
+    print 'Test preflight checks are done once per layer'
+    for i in range(3):
+        tools.assert_equals(
+            gs.do_preflight_checks(GS_WORKSPACE, GS_LYRNAME), 'shape')
+    tools.assert_equals(calls, [GS_LYRNAME])
+
+def test_preflight_checks_concurrent():
+    gs = GeoServer(GS_URL)
+    calls = []
+    def do_preflight_wfs(workspace, layername):
+        calls.append(layername)
+        time.sleep(0.1)
+        return dict(wfs_available=True, features_present=True,
+            geometry_name='shape')
+    gs.do_preflight_wfs = do_preflight_wfs
+    print 'Test concurrent preflight checks of a layer are done once'
+    threads = [threading.Thread(target=gs.do_preflight_checks,
+        args=(GS_WORKSPACE, GS_LYRNAME)) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    tools.assert_equals(calls, [GS_LYRNAME])
+
+def test_preflight_checks_disk_cache():
+    path = tempfile.mkdtemp()
+    calls = []
+    def do_preflight_wfs(workspace, layername):
+        calls.append(layername)
+        return dict(wfs_available=True, features_present=True,
+            geometry_name='shape')
+    print 'Test preflight checks are reused from disk cache between instances'
+    for i in range(2):
+        gs = GeoServer(GS_URL, preflight_cache={"path": path, "ttl": 60})
+        gs.do_preflight_wfs = do_preflight_wfs
+        tools.assert_equals(
+            gs.do_preflight_checks(GS_WORKSPACE, GS_LYRNAME), 'shape')
+    tools.assert_equals(calls, [GS_LYRNAME])
+    shutil.rmtree(path)
+
+###
+# Geometry type discovery
+###
+
+def test_parse_geometry_types_single():
+    gs = GeoServer(GS_URL)
+    inputs = {"featureTypes": [{"typeName": "magic", "properties": [
+        {"name": "id", "type": "xsd:int", "localType": "int"},
+        {"name": "shape", "type": "gml:MultiSurface", "localType": "MultiSurface"}
+    ]}]}
+    print 'Test geometry types from DescribeFeatureType for a polygon layer'
+    tools.assert_equals(gs.parse_geometry_types(inputs), ['Polygon'])
+
+def test_parse_geometry_types_generic():
+    gs = GeoServer(GS_URL)
+    inputs = {"featureTypes": [{"typeName": "magic", "properties": [
+        {"name": "shape", "type": "gml:Geometry", "localType": "Geometry"}
+    ]}]}
+    print 'Test geometry types from DescribeFeatureType for a generic geometry layer'
+    tools.assert_equals(
+        gs.parse_geometry_types(inputs), ['Point', 'LineString', 'Polygon'])
+
+def test_get_geometry_types():
+    gs = GeoServer(GS_URL)
+    print 'Test geometry types discovery for %s' % GS_LYRNAME
+    geometrytypes = gs.get_geometry_types(GS_LYRNAME)
+    tools.assert_true(len(geometrytypes) > 0)
+    for gt in geometrytypes:
+        tools.assert_in(gt, ['Point', 'LineString', 'Polygon'])
+
+###
+# WMS capabilities
+###
+
+GS_CAPABILITIES = """<?xml version="1.0" encoding="UTF-8"?>
+<WMT_MS_Capabilities version="1.1.1">
+  <Capability>
+    <Layer>
+      <Title>GeoServer</Title>
+      <Layer queryable="1">
+        <Name>magic</Name>
+        <Title>Black magic</Title>
+        <SRS>EPSG:3301</SRS>
+        <LatLonBoundingBox minx="21.0" miny="57.5" maxx="28.5" maxy="59.8"/>
+        <BoundingBox SRS="EPSG:3301" minx="360000.0" miny="6370000.0" maxx="740000.0" maxy="6640000.0"/>
+        <Style><Name>magic</Name><Title>Magic</Title></Style>
+        <Style><Name>magic_halo</Name><Title>Magic with halo</Title></Style>
+      </Layer>
+    </Layer>
+  </Capability>
+</WMT_MS_Capabilities>
+"""
+
+def test_parse_capabilities():
+    gs = GeoServer(GS_URL)
+    print 'Test parsing WMS capabilities of a workspace'
+    layers = gs.parse_capabilities(GS_CAPABILITIES, 'black')
+    tools.assert_equals(layers.keys(), ['black:magic'])
+    info = layers['black:magic']
+    tools.assert_equals(info['title'], 'Black magic')
+    tools.assert_equals(info['styles'], ['magic', 'magic_halo'])
+    tools.assert_equals(info['srs'], 'EPSG:3301')
+    tools.assert_equals(info['bbox'], [360000, 6370000, 740000, 6640000])
+    tools.assert_equals(info['latlonbbox'], [21, 57.5, 28.5, 59.8])
+
+def test_capabilities_parsed_once():
+    gs = GeoServer(GS_URL)
+    parsed = []
+    gs._do_query = lambda returns, url, **params: GS_CAPABILITIES
+    def parse_capabilities(data, workspace=None):
+        parsed.append(workspace)
+        return GeoServer.parse_capabilities(gs, data, workspace)
+    gs.parse_capabilities = parse_capabilities
+    print 'Test WMS capabilities are parsed once'
+    for i in range(3):
+        layers = gs.get_capabilities('parsed_once')
+    tools.assert_equals(layers.keys(), ['parsed_once:magic'])
+    tools.assert_equals(parsed, ['parsed_once'])
+
 ###
 # Building CQL_FILTER for geometrytype
 ###
@@ -209,6 +449,103 @@ def test_get_feature_polygon():
         tools.assert_in('geometry', feature)
         tools.assert_in(feature['geometry']['type'], ['Polygon', 'MultiPolygon'])
 
+def test_get_feature_geometry_only():
+    gs = GeoServer(GS_URL)
+    gs._preflight[GS_LYRNAME] = dict(wfs_available=True,
+        features_present=True, geometry_name=GS_LYRGEOMNAME)
+    requested = []
+    def _do_wfs_get_feature(workspace, **params):
+        requested.append(params)
+        return {"features": []}
+    gs._do_wfs_get_feature = _do_wfs_get_feature
+    print 'Test GetFeature for geometry property only'
+    gs.get_feature(GS_LYRNAME, 'Point', geometry_only=True)
+    tools.assert_equals(requested[0]['propertyName'], GS_LYRGEOMNAME)
+    gs.get_feature(GS_LYRNAME, 'Point')
+    tools.assert_not_in('propertyName', requested[1])
+
+def _square(fid, size):
+    return dict(id=fid, type='Feature', geometry_name=GS_LYRGEOMNAME,
+        geometry=dict(type='Polygon', coordinates=[
+            [[0, 0], [size, 0], [size, size], [0, size], [0, 0]]]))
+
+def _bbox_features():
+    ring = [[0, 0], [3000, 0], [3000, 2000], [0, 2000], [0, 0]]
+    hole = [[100, 100], [100, 900], [900, 900], [900, 100], [100, 100]]
+    small = [[0, 0], [0, 800], [300, 900], [0, 0]]
+    line = [[10, 10], [2000, 10], [2000, 3000], [2500, 3000]]
+    geometries = [
+        dict(type='Point', coordinates=[661531, 6399278]),
+        dict(type='LineString', coordinates=line),
+        dict(type='Polygon', coordinates=[ring, hole]),
+        dict(type='MultiPoint', coordinates=[[0, 0], [10, 50], [7, 7]]),
+        dict(type='MultiLineString', coordinates=[line, ring]),
+        dict(type='MultiPolygon', coordinates=[[ring], [small]]),
+        dict(type='Polygon', coordinates=[small]),
+        dict(type='MultiPolygon', coordinates=[[ring, hole], [small]]),
+        dict(type='MultiLineString', coordinates=[line[::-1]]),
+        dict(type='Polygon', coordinates=[ring])
+    ]
+    return [dict(type='Feature', geometry=g) for g in geometries]
+
+def test_get_bboxes_from_features():
+    for whole_feature in (True, False):
+        print 'Test batch bboxes with whole_feature %s' % whole_feature
+        conf = dict(whole_feature=whole_feature)
+        single = Legend(GeoServer, GS_URL, GS_LYRNAME, conf)
+        batch = Legend(GeoServer, GS_URL, GS_LYRNAME, conf)
+        features = _bbox_features()
+        expected = [single.get_bbox_from_feature(f) for f in features]
+        bboxes = batch.get_bboxes_from_features(
+            dict(type='FeatureCollection', features=features))
+        tools.assert_equals(len(bboxes), len(expected))
+        for bbox, e in zip(bboxes, expected):
+            for v, ev in zip(bbox, e):
+                tools.assert_almost_equals(v, ev, places=6)
+        tools.assert_equals(batch.whole_feature, single.whole_feature)
+
+def test_legend_sampling():
+    features = [_square('f.1', 1), _square('f.2', 4000), _square('f.3', 10)]
+    requested = []
+    def get_features(layername, geometrytype, additional_filter=None,
+        count=1, geometry_only=False):
+        requested.append(count)
+        return features[:count]
+    tmp = tempfile.mkdtemp()
+    try:
+        print 'Test largest feature is sampled and recorded in sample index'
+        conf = dict(sampling='largest', sample_count=3)
+        l = Legend(GeoServer, GS_URL, GS_LYRNAME, conf,
+            sample_index=dict(path=tmp))
+        l.server.get_features = get_features
+        bbox, geometry_name = l.get_sample_extent('Polygon')
+        tools.assert_equals(requested, [3])
+        tools.assert_equals(geometry_name, GS_LYRGEOMNAME)
+        tools.assert_true(bbox[2] - bbox[0] > 4000)
+        print 'Test recorded sample is reused'
+        l = Legend(GeoServer, GS_URL, GS_LYRNAME, conf,
+            sample_index=dict(path=tmp))
+        l.server.get_features = get_features
+        tools.assert_equals(l.get_sample_extent('Polygon'),
+            (bbox, geometry_name))
+        tools.assert_equals(requested, [3])
+        print 'Test median feature is sampled'
+        l.update_conf(GS_LYRNAME, dict(sampling='median', sample_count=3))
+        bbox, _ = l.get_sample_extent('Polygon')
+        tools.assert_true(10 < bbox[2] - bbox[0] < 4000)
+        print 'Test largest of all features picked at random is sampled'
+        l.update_conf(GS_LYRNAME, dict(sampling='random', sample_count=3,
+            sample_random_n=3))
+        bbox, _ = l.get_sample_extent('Polygon')
+        tools.assert_true(bbox[2] - bbox[0] > 4000)
+    finally:
+        shutil.rmtree(tmp)
+
+@tools.raises(AssertionError)
+def test_legend_sampling_unknown():
+    print 'Test unknown sampling strategy is refused'
+    Legend(GeoServer, GS_URL, GS_LYRNAME, dict(sampling='magic'))
+
 ###
 # WMS GetMap
 ###
@@ -245,6 +582,49 @@ def test_get_map_gs_linestring():
     tools.assert_is_instance(img, PngImageFile)
     img.save(out_filename, 'PNG')
 
+def test_get_mosaic():
+    gs = GeoServer(GS_URL)
+    requested = []
+    def _do_wms_get_map(workspace, **params):
+        requested.append(params)
+        data = StringIO()
+        Image.new('RGBA', (params['width'], params['height'])).save(data, 'PNG')
+        return data.getvalue()
+    gs._do_wms_get_map = _do_wms_get_map
+    inputs = (GS_LYRNAME, [
+        ('Point', GS_LYRGEOMNAME, GS_LYRBBOX_POINT),
+        ('Polygon', GS_LYRGEOMNAME, (661631, 6399278, 661831, 6399478))
+    ], GS_LYRSRS)
+    print 'Test GetMap mosaic for several geometry types'
+    images = gs.get_mosaic(*inputs, size=(100, 100))
+    tools.assert_equals(len(requested), 1)
+    tools.assert_equals(requested[0]['layers'], ','.join([GS_LYRNAME] * 2))
+    tools.assert_equals(len(requested[0]['cql_filter'].split(';')), 2)
+    tools.assert_equals(
+        (requested[0]['width'], requested[0]['height']), (200, 150))
+    tools.assert_equals(len(images), 2)
+    for img, bck in images:
+        tools.assert_equals(img.size, (100, 100))
+        tools.assert_is_none(bck)
+
+def test_get_mosaic_resolutions_differ():
+    gs = GeoServer(GS_URL)
+    inputs = (GS_LYRNAME, [
+        ('Point', GS_LYRGEOMNAME, GS_LYRBBOX_POINT),
+        ('Polygon', GS_LYRGEOMNAME, (661631, 6399178, 662031, 6399578))
+    ], GS_LYRSRS)
+    print 'Test GetMap mosaic is refused for extents of other resolutions'
+    tools.assert_is_none(gs.get_mosaic(*inputs, size=(100, 100)))
+
+def test_get_mosaic_too_large():
+    gs = GeoServer(GS_URL)
+    inputs = (GS_LYRNAME, [
+        ('Point', GS_LYRGEOMNAME, GS_LYRBBOX_POINT),
+        ('Polygon', GS_LYRGEOMNAME, GS_LYRBBOX_POLYGON)
+    ], GS_LYRSRS)
+    print 'Test GetMap mosaic is refused for far apart extents'
+    tools.assert_is_none(gs.get_mosaic(*inputs, size=(100, 100)))
+
 ###
 # Building a legend
 ###
@@ -302,6 +682,135 @@ def test_legend_properties_minimal():
     tools.assert_true(hasattr(l, 'srs'))
     tools.assert_is_none(l.srs)
 
+def test_legend_process_thumbnails():
+    legend_conf = {}
+    print 'Test processing fetched image data into a legend image'
+    l = Legend(GeoServer, GS_URL, GS_LYRNAME, legend_conf)
+    data = StringIO()
+    Image.new('RGBA', (50, 50), (255, 0, 0, 255)).save(data, 'PNG')
+    empty = StringIO()
+    Image.new('RGBA', (50, 50), (255, 255, 255, 255)).save(empty, 'PNG')
+    img = l.process_thumbnails([(data.getvalue(), None), (empty.getvalue(), None)])
+    tools.assert_equals(img.size, (50 + 2 * 10, 50 + 2 * 10))
+
+def test_encode_image():
+    img = Image.new('RGBA', (60, 40), (255, 255, 255, 255))
+    img.paste((200, 30, 30, 255), (10, 10, 30, 30))
+    for output, fmt in [
+        (None, 'PNG'),
+        ({"optimize": True, "compress_level": 9}, 'PNG'),
+        ({"palette": True, "colors": 16}, 'PNG'),
+        ({"format": "webp"}, 'WEBP')]:
+        print 'Test encoding output image losslessly with %s' % output
+        encoded = Image.open(StringIO(encode_image(img, output)))
+        tools.assert_equals(encoded.format, fmt)
+        tools.assert_equals(list(encoded.convert('RGBA').getdata()),
+            list(img.getdata()))
+
+def test_legend_write_image_scales():
+    path = tempfile.mkdtemp()
+    l = Legend(GeoServer, GS_URL, GS_LYRNAME, {"scale": 2})
+    tools.assert_equals((l._size, l.get_dpi()), ((100, 100), 180))
+    img = Image.new('RGBA', (120, 80), (255, 0, 0, 255))
+    print 'Test writing legend image in several scales'
+    files = l.write_image(img, path, 'magic.png',
+        {"format": "webp", "scales": [1, 2]})
+    tools.assert_equals(files, [os.path.join(path, 'magic.webp'),
+        os.path.join(path, 'magic@2x.webp')])
+    tools.assert_equals([Image.open(f).size for f in files],
+        [(60, 40), (120, 80)])
+    shutil.rmtree(path)
+
+def test_legend_stream_to():
+    path = tempfile.mkdtemp()
+    img = Image.new('RGBA', (70, 70), (255, 0, 0, 255))
+    print 'Test thumbnails are written as soon as they are added'
+    l = Legend(GeoServer, GS_URL, GS_LYRNAME, {})
+    l.stream_to(path, 'magic.png')
+    l.add_thumb('magic__a.png', img)
+    tools.assert_true(os.path.exists(os.path.join(path, 'magic__a.png')))
+    l.add_thumb('magic__b.png', None)
+    l.add_thumb('magic__c.png', img)
+    tools.assert_equals(l._thumbs, [])
+    tools.assert_equals(l.save(), [os.path.join(path, 'magic__a.png'),
+        os.path.join(path, 'magic__c.png')])
+    print 'Test grouped thumbnails are kept encoded until saved'
+    l.stream_to(path, 'magic.png', group=True)
+    l.add_thumb('magic__a.png', img)
+    l.add_thumb('magic__b.png', img)
+    tools.assert_equals([type(d.values()[0]) for d in l._thumbs], [str, str])
+    tools.assert_equals(l.save(), [os.path.join(path, 'magic.png')])
+    tools.assert_equals(Image.open(os.path.join(path, 'magic.png')).size,
+        (70 + 2 * 10, 2 * 70 + 3 * 10))
+    tools.assert_equals(l._thumbs, [])
+    shutil.rmtree(path)
+
+def test_mask_cached():
+    print 'Test thumbnail masks are cached'
+    mask = get_mask((50, 50))
+    tools.assert_is(get_mask((50, 50)), mask)
+    tools.assert_is_not(get_mask((50, 50), 'roundrect'), mask)
+    tools.assert_equals(mask.size, (50, 50))
+    # transparent inside, opaque corners
+    tools.assert_equals(mask.getpixel((25, 25))[3], 0)
+    tools.assert_equals(mask.getpixel((0, 0))[3], 255)
+
+@tools.raises(AssertionError)
+def test_mask_unknown_shape():
+    print 'Test unknown thumbnail mask shape'
+    get_mask((50, 50), 'hexagon')
+
+def test_is_empty_image():
+    print 'Test empty image detection matches grayscale conversion'
+    l = Legend(GeoServer, GS_URL, GS_LYRNAME, {})
+    images = [
+        Image.new('RGBA', (50, 50), (255, 255, 255, 0)),
+        Image.new('RGB', (50, 50), (0, 0, 0)),
+        Image.new('RGB', (50, 50), (1, 0, 1)),
+        Image.new('RGB', (50, 50), (255, 254, 255)),
+        Image.new('RGB', (50, 50), (128, 128, 128)),
+        Image.new('L', (50, 50), 255),
+    ]
+    drawn = Image.new('RGBA', (50, 50), (255, 255, 255, 0))
+    drawn.putpixel((10, 10), (200, 30, 30, 255))
+    images.append(drawn)
+    almost_white = Image.new('RGB', (50, 50), (255, 255, 255))
+    almost_white.putpixel((10, 10), (254, 255, 254))
+    images.append(almost_white)
+    for img in images:
+        tools.assert_equals(
+            l.is_empty_image(img), l._is_empty_image_grayscale(img))
+
+def test_empty_map_learned():
+    print 'Test empty GetMap responses are learned'
+    l = Legend(GeoServer, GS_URL, GS_LYRNAME, {})
+    empty = StringIO()
+    Image.new('RGB', (42, 42), (255, 255, 255)).save(empty, 'PNG')
+    empty = empty.getvalue()
+    key = empty_map_key((42, 42), False)
+    tools.assert_false(is_empty_map(key, empty))
+    learned = []
+    tools.assert_is_none(l.process_thumbnails([(empty, None)], learned=learned))
+    tools.assert_equals(len(learned), 1)
+    tools.assert_true(is_empty_map(key, empty))
+    tools.assert_false(is_empty_map(empty_map_key((42, 42), True), empty))
+    tools.assert_false(is_empty_map(key, empty[:-1] + 'x'))
+
+def test_legend_pickle():
+    legend_conf = {"title": "wat?"}
+    print 'Test Legend can be passed to image processing processes'
+    l = Legend(GeoServer, GS_URL, GS_LYRNAME, legend_conf)
+    _l = pickle.loads(pickle.dumps(l))
+    tools.assert_is_none(_l.server)
+    tools.assert_equals(_l.title, l.title)
+
+def test_legend_font():
+    print 'Test Legend label font is configurable'
+    l = Legend(GeoServer, GS_URL, GS_LYRNAME, {})
+    tools.assert_equals(l.font, Legend.font)
+    l.update_conf(GS_LYRNAME, {"font": "/path/to/font.ttf"})
+    tools.assert_equals(l.font, "/path/to/font.ttf")
+
 def test_legend_thumbnail_create_minimal():
     legend_conf = {
         "srs":"EPSG:3301"
@@ -324,6 +833,21 @@ def test_legend_thumbnail_create_with_bbox_no_srs():
     l = Legend(GeoServer, GS_URL, GS_LYRNAME, legend_conf)
     l.create_thumbnails('./test_img')
 
+def test_legend_thumbnail_create_with_bbox():
+    requested = []
+    class BboxGeoServer(GeoServer):
+        def get_map(self, layername, geometrytype, geometryname, bbox, srs,
+            **kwargs):
+            requested.append((geometrytype, kwargs['geometrytype_filtering']))
+            img = Image.new('RGBA', (70, 70), (255, 0, 0, 255))
+            return dump_image(img), None
+    legend_conf = {"bbox": [1, 2, 3, 4], "srs": "EPSG:3301"}
+    print 'Test a preset bbox gives a single unfiltered thumbnail'
+    l = Legend(BboxGeoServer, GS_URL, GS_LYRNAME, legend_conf)
+    l.create_thumbnails()
+    tools.assert_equals(requested, [(None, False)])
+    tools.assert_equals(len(l._thumbs), 1)
+
 ###
 # bbox creation from sample feature
 ###
@@ -355,6 +879,30 @@ def test_bbox_creation_point_custom_buffer():
         expect
     )
 
+def test_bbox_creation_point_configured_buffer():
+    legend_conf = {"buffer_size": 42}
+    print 'Test bbox creation for a point feature, configured buffer size'
+    l = Legend(GeoServer, GS_URL, GS_LYRNAME, legend_conf)
+    inputs = (
+        {"type":"Feature", "geometry": {"type":"Point", "coordinates":[500, 500]}, "properties":{"id":0}},
+    )
+    expect = (458, 458, 542, 542)
+    tools.assert_equals(
+        l.get_bbox_from_feature(*inputs),
+        expect
+    )
+
+def test_bbox_creation_point_geographic_srs():
+    legend_conf = {"buffer_size": 1113.2, "srs": "EPSG:4326"}
+    print 'Test bbox creation for a point feature, buffer size in degrees'
+    l = Legend(GeoServer, GS_URL, GS_LYRNAME, legend_conf)
+    inputs = (
+        {"type":"Feature", "geometry": {"type":"Point", "coordinates":[24.7, 59.4]}, "properties":{"id":0}},
+    )
+    expect = (24.69, 59.39, 24.71, 59.41)
+    for v, e in zip(l.get_bbox_from_feature(*inputs), expect):
+        tools.assert_almost_equals(v, e, places=6)
+
 def test_bbox_creation_linestring_default_buffer():
     legend_conf = {}
     print 'Test bbox creation for a linestring feature, default buffer sizer'
@@ -462,3 +1010,247 @@ def test_bbox_creation_multilinestring_custom_buffer():
         l.get_bbox_from_feature(*inputs),
         expect
     )
+
+###
+# Running jobs
+###
+
+def test_build_jobs():
+    conf = {
+        GS_URL: {
+            "out_path": ".",
+            "size": {"width": 100, "height": 100},
+            "workers": 2,
+            "layers": [
+                {GS_LYRNAME: {"filters": [{"srs": GS_LYRSRS}]}},
+                {'black:magic': {"filters": [], "group": True}}
+            ]
+        }
+    }
+    print 'Test building flat job list from nested configuration'
+    jobs = build_jobs(conf)
+    tools.assert_equals(len(jobs), 2)
+    tools.assert_equals(
+        sorted([job['layername'] for job in jobs]),
+        sorted([GS_LYRNAME, 'black:magic'])
+    )
+    for job in jobs:
+        tools.assert_equals(job['server'], GS_URL)
+        tools.assert_equals((job['width'], job['height']), (100, 100))
+        tools.assert_is_none(job['username'])
+
+def test_run_stream():
+    jobs = StringIO('\n'.join([
+        json.dumps({"server": GS_URL, "layername": GS_LYRNAME,
+            "layerconf": {"filters": []}}),
+        '',
+        '{"server": "broken json',
+    ]))
+    results = StringIO()
+    print 'Test running jobs from JSON lines'
+    run_stream(jobs, results)
+    results = [json.loads(line) for line in results.getvalue().splitlines()]
+    tools.assert_equals(len(results), 2)
+    tools.assert_equals(results[0]['line'], 1)
+    tools.assert_equals(results[0]['status'], 'ok')
+    tools.assert_equals(results[0]['layername'], GS_LYRNAME)
+    tools.assert_equals(results[1]['line'], 3)
+    tools.assert_equals(results[1]['status'], 'error')
+
+def test_run_stream_failing_results():
+    jobs = StringIO('\n'.join([json.dumps({"server": GS_URL,
+        "layername": GS_LYRNAME, "layerconf": {"filters": []}})] * 4))
+    class BrokenPipe(object):
+        def write(self, data):
+            raise IOError('Broken pipe')
+    print 'Test jobs keep running when writing results fails'
+    t = threading.Thread(target=run_stream, args=(jobs, BrokenPipe(), 2))
+    t.daemon = True
+    t.start()
+    t.join(10)
+    tools.assert_false(t.is_alive())
+
+def test_pack():
+    sizes = [(300, 120), (100, 40), (500, 60), (100, 40), (90, 200),
+        (600, 30), (250, 250), (40, 40)]
+    print 'Test packing rectangles into sprite sheets without overlaps'
+    positions, sheets = pack(sizes, max_size=600, padding=2)
+    tools.assert_equals(len(positions), len(sizes))
+    tools.assert_equals(len(sheets), 2)
+    rects = [(n, x, y, x + w, y + h)
+        for (n, x, y), (w, h) in zip(positions, sizes)]
+    for i, (n, x0, y0, x1, y1) in enumerate(rects):
+        width, height = sheets[n]
+        tools.assert_true(x1 <= width <= 600 and y1 <= height <= 600)
+        for m, _x0, _y0, _x1, _y1 in rects[i + 1:]:
+            tools.assert_true(m != n or x1 <= _x0 or _x1 <= x0 or
+                y1 <= _y0 or _y1 <= y0)
+    print 'Test oversized rectangles widen their sheet'
+    positions, sheets = pack([(700, 10), (10, 10)], max_size=600)
+    tools.assert_equals(positions, [(0, 0, 0), (0, 0, 12)])
+    tools.assert_equals(sheets, [(700, 22)])
+
+def test_write_sprites():
+    path = tempfile.mkdtemp()
+    legends = []
+    for n, (color, size) in enumerate([
+        ('red', (60, 20)), ('green', (20, 60)), ('blue', (30, 30))]):
+        filename = os.path.join(path, 'legend%s.png' % n)
+        Image.new('RGBA', size, color).save(filename)
+        legends.append((filename, 'Legend %s' % n))
+    print 'Test writing sprite sheets with index'
+    files = write_sprites(legends, os.path.join(path, 'sprites'))
+    tools.assert_equals(files, [os.path.join(path, 'sprites-0.png'),
+        os.path.join(path, 'sprites.json')])
+    with open(files[-1]) as f:
+        index = json.loads(f.read())
+    tools.assert_equals(index['sheets'], ['sprites-0.png'])
+    sheet = Image.open(files[0]).convert('RGBA')
+    for n, (filename, title) in enumerate(legends):
+        entry = index['legends']['legend%s' % n]
+        tools.assert_equals(entry['title'], title)
+        img = Image.open(filename)
+        tools.assert_equals((entry['width'], entry['height']), img.size)
+        box = (entry['x'], entry['y'],
+            entry['x'] + entry['width'], entry['y'] + entry['height'])
+        tools.assert_equals(list(sheet.crop(box).getdata()),
+            list(img.getdata()))
+    shutil.rmtree(path)
+
+def test_write_sprites_same_name():
+    path = tempfile.mkdtemp()
+    legends = []
+    for server in ['a', 'b']:
+        os.makedirs(os.path.join(path, server))
+        filename = os.path.join(path, server, 'black_magic.png')
+        Image.new('RGBA', (20, 20), 'red').save(filename)
+        legends.append((filename, 'Black magic'))
+    legends.append((legends[0][0], 'Black magic'))
+    print 'Test legends of the same name are indexed by relative path'
+    files = write_sprites(legends, os.path.join(path, 'sprites'))
+    with open(files[-1]) as f:
+        index = json.loads(f.read())
+    tools.assert_equals(sorted(index['legends'].keys()),
+        [os.path.join('a', 'black_magic'), os.path.join('b', 'black_magic')])
+    tools.assert_equals(Image.open(files[0]).size, (42, 20))
+    shutil.rmtree(path)
+
+def test_manifest_current():
+    path = tempfile.mkdtemp()
+    out_file = os.path.join(path, 'magic.png')
+    open(out_file, 'w').close()
+    print 'Test manifest knows about outputs built from unchanged inputs'
+    job = {"layername": "black:magic", "layerconf": {"filters": []}}
+    signature = job_signature(job, {"default": "abc"})
+    manifest = Manifest(path)
+    tools.assert_false(manifest.is_current('magic', signature))
+    manifest.update('magic', dict(signature=signature, files=[out_file]))
+    manifest = Manifest(path)
+    tools.assert_true(manifest.is_current('magic', signature))
+    tools.assert_false(manifest.is_current(
+        'magic', job_signature(job, {"default": "def"})))
+    os.remove(out_file)
+    tools.assert_false(manifest.is_current('magic', signature))
+    shutil.rmtree(path)
+
+def test_job_signature_unknown_style():
+    print 'Test job signature is undetermined with unknown style fingerprint'
+    tools.assert_is_none(job_signature({}, {"default": None}))
+    path = tempfile.mkdtemp()
+    out_file = os.path.join(path, 'magic.png')
+    open(out_file, 'w').close()
+    print 'Test outputs with undetermined signature are never current'
+    manifest = Manifest(path)
+    manifest.update('magic', dict(signature=None, files=[out_file]))
+    manifest = Manifest(path)
+    tools.assert_false(manifest.is_current('magic', None))
+    shutil.rmtree(path)
+
+###
+# Legend service
+###
+
+class SlowLegendService(LegendService):
+    renders = 0
+    def render(self, job):
+        self.renders += 1
+        time.sleep(0.2)
+        return 'legend of %s' % job['layername']
+
+def test_legend_service_job():
+    service = LegendService({GS_URL: {"size": {"width": 40, "height": 40}}})
+    print 'Test legend service builds jobs from request parameters'
+    job = service.get_job(dict(layer=GS_LYRNAME, style='magic',
+        bbox='1,2,3,4'))
+    tools.assert_equals(job['server'], GS_URL)
+    tools.assert_equals((job['width'], job['height']), (40, 40))
+    tools.assert_equals(job['layerconf']['filters'], [
+        dict(styles=['magic'], bbox=[1, 2, 3, 4], scale=1)])
+    tools.assert_raises(ValueError, service.get_job, {})
+    tools.assert_raises(ValueError, service.get_job,
+        dict(layer=GS_LYRNAME, bbox='1,2,3'))
+
+def test_legend_service_coalescing():
+    service = SlowLegendService({GS_URL: {}})
+    job = service.get_job(dict(layer=GS_LYRNAME))
+    results = []
+    def request():
+        results.append(service.get_legend(job))
+    print 'Test concurrent requests for a legend are rendered once'
+    threads = [threading.Thread(target=request) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    tools.assert_equals(service.renders, 1)
+    tools.assert_equals(results, ['legend of %s' % GS_LYRNAME] * 5)
+    print 'Test rendered legends are served from cache'
+    service.get_legend(job)
+    tools.assert_equals(service.renders, 1)
+    metrics = service.get_metrics()
+    tools.assert_equals((metrics['requests'], metrics['misses'],
+        metrics['coalesced'], metrics['hits']), (6, 1, 4, 1))
+    tools.assert_equals(metrics['hit_rate'], round(5 / 6.0, 4))
+
+def test_legend_service_render_finished():
+    service = SlowLegendService({GS_URL: {}})
+    job = service.get_job(dict(layer=GS_LYRNAME))
+    class RacingCache(LRUCache):
+        race = True
+        def get(self, key):
+            data = LRUCache.get(self, key)
+            if self.race:
+                self.race = False
+                # another request renders the legend after this miss
+                t = threading.Thread(target=service.get_legend, args=(job,))
+                t.start()
+                t.join()
+            return data
+    service.cache = RacingCache(16)
+    print 'Test a legend rendered right after a cache miss is not rendered again'
+    tools.assert_equals(service.get_legend(job), 'legend of %s' % GS_LYRNAME)
+    tools.assert_equals(service.renders, 1)
+    metrics = service.get_metrics()
+    tools.assert_equals((metrics['requests'], metrics['misses'],
+        metrics['hits']), (2, 1, 1))
+
+def test_legend_service_http():
+    service = SlowLegendService({GS_URL: {}})
+    server = LegendServer(('localhost', 0), service)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    url = 'http://localhost:%s' % server.server_address[1]
+    try:
+        print 'Test legends are served over HTTP'
+        r = requests.get(url + '/legend', params=dict(layer=GS_LYRNAME))
+        tools.assert_equals(r.status_code, 200)
+        tools.assert_equals(r.headers['Content-Type'], 'image/png')
+        tools.assert_equals(r.content, 'legend of %s' % GS_LYRNAME)
+        r = requests.get(url + '/legend')
+        tools.assert_equals(r.status_code, 400)
+        r = requests.get(url + '/metrics')
+        tools.assert_equals(r.json()['misses'], 1)
+    finally:
+        server.shutdown()
+        server.server_close()